@@ -0,0 +1,218 @@
+import asyncio
+import os
+import queue
+import config
+import storage
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Awaitable access to SQLite files, so disk stalls don't freeze the event
+# loop. Each file gets one writer thread, which commits once per batch of
+# queued writes, and a small pool of reader threads. Writes return after
+# they've been committed, so a read that follows an awaited write sees it.
+
+MAX_BATCH = 64
+
+_STOP = object()
+
+class WriteRequest(object):
+    __slots__ = ("method", "sql", "params", "future", "loop")
+
+    def __init__(self, method, sql, params, future, loop):
+        self.method = method
+        self.sql = sql
+        self.params = params
+        self.future = future
+        self.loop = loop
+
+def settle(future, result, error):
+    if future.done():
+        return
+
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+def run_transaction(connection, steps):
+    """ Run the steps of a transaction() on the writer thread. The
+        savepoint lets a failed step undo the earlier ones without
+        touching the other writes in the batch. """
+
+    connection.execute("SAVEPOINT asyncdb_transaction")
+    try:
+        rowcounts = [getattr(connection, method)(sql, params).rowcount for method, sql, params in steps]
+    except Exception:
+        connection.execute("ROLLBACK TO asyncdb_transaction")
+        connection.execute("RELEASE asyncdb_transaction")
+        raise
+
+    connection.execute("RELEASE asyncdb_transaction")
+    return rowcounts
+
+class Database(object):
+    """ Use open_database instead of creating these directly, so every
+        user of a file shares its writer thread. """
+
+    def __init__(self, path, readers=2):
+        self.path = path
+        self.writes = queue.Queue()
+        self.local = threading.local()
+        self.reader_pool = ThreadPoolExecutor(readers)
+
+        self.writer = threading.Thread(target=self.write_loop, name="asyncdb writer: " + path, daemon=True)
+        self.writer.start()
+
+    def migrate(self, migrations):
+        """ Bring the file's schema up to date right away, on the calling
+            thread. Only meant for startup, before anything else uses it.
+            See storage.migrate. """
+
+        connection = storage.connect(self.path)
+        try:
+            storage.migrate(connection, migrations, self.path)
+        finally:
+            connection.close()
+
+    # -- writes --
+
+    def write_loop(self):
+        connection = storage.connect(self.path)
+
+        while 1:
+            batch = [self.writes.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+
+            done = []
+            stopping = 0
+            for request in batch:
+                if request is _STOP:
+                    stopping = 1
+                    continue
+
+                try:
+                    if request.method == "executescript":
+                        connection.executescript(request.sql)
+                        result = None
+                    elif request.method == "transaction":
+                        result = run_transaction(connection, request.params)
+                    else:
+                        result = getattr(connection, request.method)(request.sql, request.params).rowcount
+                except Exception as e:
+                    done.append((request, None, e))
+                else:
+                    done.append((request, result, None))
+
+            try:
+                connection.commit()
+            except Exception as e:
+                done = [(request, None, e) for request, _, _ in done]
+
+            for request, result, error in done:
+                request.loop.call_soon_threadsafe(settle, request.future, result, error)
+
+            if stopping:
+                connection.close()
+                return
+
+    def submit_write(self, method, sql, params):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.writes.put(WriteRequest(method, sql, params, future, loop))
+        return future
+
+    async def execute(self, sql, params=()):
+        """ Run a write statement. Returns the number of rows changed. """
+        return await self.submit_write("execute", sql, params)
+
+    async def executemany(self, sql, seq_of_params):
+        return await self.submit_write("executemany", sql, list(seq_of_params))
+
+    async def executescript(self, script):
+        return await self.submit_write("executescript", script, None)
+
+    async def transaction(self, steps):
+        """ Run several writes so that they're committed together or not
+            at all; readers never see some of them without the others.
+            steps is a list of ("execute", sql, params) and
+            ("executemany", sql, seq_of_params). Returns the number of
+            rows each step changed. """
+
+        steps = [(method, sql, list(params) if method == "executemany" else params)
+                 for method, sql, params in steps]
+        return await self.submit_write("transaction", None, steps)
+
+    # -- reads --
+
+    def reader_connection(self):
+        connection = getattr(self.local, "connection", None)
+
+        if connection is None:
+            connection = self.local.connection = storage.connect(self.path)
+
+        return connection
+
+    def run_query(self, sql, params):
+        return self.reader_connection().execute(sql, params).fetchall()
+
+    async def query(self, sql, params=()):
+        """ Run a SELECT and return all of its rows. """
+        return await asyncio.get_event_loop().run_in_executor(self.reader_pool, self.run_query, sql, params)
+
+    async def query_one(self, sql, params=()):
+        rows = await self.query(sql, params)
+        return rows[0] if rows else None
+
+    async def maintain(self):
+        """ Refresh the query planner's statistics and fold the WAL back
+            into the database file. """
+
+        await self.execute("ANALYZE")
+        await self.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        """ Finish queued writes and stop the threads. """
+
+        self.writes.put(_STOP)
+        self.writer.join()
+        self.reader_pool.shutdown(wait=True)
+
+_databases = {}
+
+def open_database(path, migrations=None):
+    """ The shared Database for path, migrated to the latest version of
+        its schema. """
+
+    key = os.path.abspath(path)
+    db = _databases.get(key)
+
+    if db is None:
+        db = Database(path)
+        if migrations is not None:
+            db.migrate(migrations)
+
+        _databases[key] = db
+
+    return db
+
+async def maintain_all():
+    """ Runs forever, calling maintain on every open Database every
+        storage.maintenance_interval seconds. """
+
+    while 1:
+        await asyncio.sleep(config.get("storage.maintenance_interval", 3600))
+
+        for db in list(_databases.values()):
+            try:
+                await db.maintain()
+            except Exception as e:
+                print("maintain_all: maintaining", db.path, "failed:", repr(e))
+
+def close_all():
+    while _databases:
+        _, db = _databases.popitem()
+        db.close()
@@ -1,6 +1,10 @@
-import sqlite3
+import fnmatch
+import config
+import asyncdb
+import storage
+import coordination
 import discord.errors
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from functools import partial
 
 # The set of rights declared with declare_right. You can
@@ -14,6 +18,13 @@ SCOPE_ROLE    = 200
 SCOPE_CHANNEL = 250
 SCOPE_SERVER  = 300
 
+# Scheduling priorities, derived from the right a command requires.
+# Under overload, PRIORITY_LOW commands are shed and PRIORITY_HIGH ones
+# skip the queue. See priority_of.
+PRIORITY_LOW    = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH   = 2
+
 # A right.
 flag_t = namedtuple("flag_t", ("name",))
 grant_t = namedtuple("grant_t", ("scope", "subject", "right", "permitted"))
@@ -22,70 +33,199 @@ def declare_right(name):
     KNOWN_PERMISSION_FLAGS.add(name)
     return flag_t(name)
 
+_priority_cache = {}
+
+def reload_priorities():
+    _priority_cache.clear()
+
+def priority_of(flag):
+    """ Classify a right (or None, for unguarded commands) using the
+        shed.low_priority_rights and shed.high_priority_rights lists of
+        fnmatch patterns. """
+
+    if flag is None:
+        return PRIORITY_NORMAL
+
+    pri = _priority_cache.get(flag)
+    if pri is not None:
+        return pri
+
+    low = config.get("shed.low_priority_rights", ["DERESUTE_NOISY", "USE_QUOTE"])
+    high = config.get("shed.high_priority_rights", ["MANAGE_*", "EVAL_CODE"])
+
+    if any(fnmatch.fnmatchcase(flag.name, pat) for pat in high):
+        pri = PRIORITY_HIGH
+    elif any(fnmatch.fnmatchcase(flag.name, pat) for pat in low):
+        pri = PRIORITY_LOW
+    else:
+        pri = PRIORITY_NORMAL
+
+    _priority_cache[flag] = pri
+    return pri
+
+MIGRATIONS = [
+    """CREATE TABLE IF NOT EXISTS
+        effective_permission (
+            _type INT,
+            _flagname TEXT,
+            _userid_or_group TEXT,
+            _have INT
+        )
+    """,
+    storage.dedupe("effective_permission", "_flagname, _userid_or_group, _type") + """;
+    CREATE UNIQUE INDEX effective_permission_key ON effective_permission (_flagname, _userid_or_group, _type);
+    CREATE INDEX effective_permission_subject ON effective_permission (_userid_or_group)
+    """,
+]
+
 class RightsDB(object):
+    """ Every grant is held in memory, as a pair of bitsets per (scope,
+        subject): which flags the subject has a say on, and which of those
+        it grants. Bits are handed out to flag names as they're seen.
+        Writes go to memory and the database together. """
+
     def __init__(self, path):
-        connection = sqlite3.connect(path)
-        connection.execute("""CREATE TABLE IF NOT EXISTS
-            effective_permission (
-                _type INT,
-                _flagname TEXT,
-                _userid_or_group TEXT,
-                _have INT
-            )
-        """)
-        connection.commit()
-
-        self.connection = connection
-
-    def write_permission(self, type_, subject, flag, value):
-        k = self.connection.execute("SELECT _have FROM effective_permission WHERE _flagname = ? AND _userid_or_group = ? AND _type = ?", (flag.name, subject, type_)).fetchone()
-
-        if k is None:
-            self.connection.execute("INSERT INTO effective_permission VALUES (?, ?, ?, ?)", (type_, flag.name, subject, value))
+        self.db = asyncdb.open_database(path, MIGRATIONS)
+
+        # flag name -> bit index, and the reverse
+        self.bits = {}
+        self.names = []
+        # (scope, subject) -> (decided mask, granted mask)
+        self.masks = {}
+
+        # subject_of tuple -> resolved granted mask. Dropped on every write.
+        self.resolved = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        coordination.subscribe(coordination.TOPIC_RIGHTS, self.on_remote_write)
+
+    async def load(self):
+        self.masks = {}
+        for type_, flagname, subject, have in await self.db.query(
+                "SELECT _type, _flagname, _userid_or_group, _have FROM effective_permission"):
+            self.set_bit(type_, subject, flagname, have)
+
+        self.resolved.clear()
+
+    def bit_of(self, flagname):
+        bit = self.bits.get(flagname)
+
+        if bit is None:
+            bit = self.bits[flagname] = len(self.names)
+            self.names.append(flagname)
+
+        return bit
+
+    def set_bit(self, type_, subject, flagname, value):
+        bit = 1 << self.bit_of(flagname)
+        decided, granted = self.masks.get((type_, subject), (0, 0))
+
+        if value:
+            granted |= bit
         else:
-            self.connection.execute("UPDATE effective_permission SET _have = ? WHERE _flagname = ? AND _userid_or_group = ? AND _type = ?", (value, flag.name, subject, type_))
+            granted &= ~bit
+
+        self.masks[(type_, subject)] = (decided | bit, granted)
+
+    async def write_permission(self, type_, subject, flag, value):
+        self.set_bit(type_, subject, flag.name, value)
+        self.resolved.clear()
+
+        await self.db.execute("INSERT OR REPLACE INTO effective_permission VALUES (?, ?, ?, ?)", (type_, flag.name, subject, value))
+
+        coordination.publish(coordination.TOPIC_RIGHTS,
+            {"type": type_, "subject": subject, "flag": flag.name, "value": value})
 
-        self.connection.commit()
+    def on_remote_write(self, payload):
+        self.set_bit(payload["type"], payload["subject"], payload["flag"], payload["value"])
+        self.resolved.clear()
+
+    def resolve(self, server_id, channel_id, role_ids, user_id):
+        """ The mask of flags granted to this subject. The user's own grants
+            win over their roles', which win over the channel's, which win
+            over the server's. Among roles, a grant by any of them wins. """
+
+        key = (server_id, channel_id, frozenset(role_ids), user_id)
+        granted = self.resolved.get(key)
+
+        if granted is not None:
+            self.hits += 1
+            self.resolved.move_to_end(key)
+            return granted
+
+        self.misses += 1
+
+        role_decided = role_granted = 0
+        for role_id in role_ids:
+            decided, granted = self.masks.get((SCOPE_ROLE, role_id), (0, 0))
+            role_decided |= decided
+            role_granted |= granted
+
+        tiers = (self.masks.get((SCOPE_USER, user_id), (0, 0)),
+                 (role_decided, role_granted),
+                 self.masks.get((SCOPE_CHANNEL, channel_id), (0, 0)),
+                 self.masks.get((SCOPE_SERVER, server_id), (0, 0)))
+
+        granted = 0
+        undecided = -1
+        for decided, tier_granted in tiers:
+            granted |= tier_granted & decided & undecided
+            undecided &= ~decided
+
+        if len(self.resolved) >= 4096:
+            self.resolved.popitem(last=False)
+
+        self.resolved[key] = granted
+        return granted
+
+    def has(self, granted, flag):
+        """ Whether a mask from resolve includes flag. """
+
+        bit = self.bits.get(flag.name)
+        if bit is None:
+            return 0
+
+        return (granted >> bit) & 1
+
+    def has_many(self, granted, flags):
+        """ has for several flags at once. Returns {flag: bool}. """
+
+        return {flag: flag.name in self.bits and bool((granted >> self.bits[flag.name]) & 1)
+                for flag in flags}
 
     def evaluate(self, server_id, channel_id, role_ids, user_id, flag):
         """ Check whether the message has the given right (from declare_right).
             Checks based on server, channel, roles, user ID in ascending order of
             priority. """
 
-        joined = ",".join(repr(k) for k in role_ids)
-
-        the_query = ("SELECT _have FROM effective_permission "
-            "WHERE _flagname = ? AND ( "
-            "    (_type = 300 AND _userid_or_group = ?) OR "
-            "    (_type = 250 AND _userid_or_group = ?) OR "
-            "    (_type = 200 AND _userid_or_group IN ({0})) OR "
-            "    (_type = 100 AND _userid_or_group = ?) "
-            ") ORDER BY _type").format(joined)
+        return self.has(self.resolve(server_id, channel_id, role_ids, user_id), flag)
 
-        k = self.connection.execute(the_query, (flag.name, server_id, channel_id, user_id))
+    def list_applicable(self, server_id, channel_id, role_ids, user_id):
+        subjects = [(SCOPE_USER, user_id)]
+        subjects.extend((SCOPE_ROLE, role_id) for role_id in role_ids)
+        subjects.extend(((SCOPE_CHANNEL, channel_id), (SCOPE_SERVER, server_id)))
 
-        perm = k.fetchone()
-        if perm is not None:
-            return perm[0]
+        grants = []
+        for scope, subject in subjects:
+            decided, granted = self.masks.get((scope, subject), (0, 0))
 
-        return 0
+            for bit, name in enumerate(self.names):
+                if decided >> bit & 1:
+                    grants.append(grant_t(scope, subject, flag_t(name), granted >> bit & 1))
 
-    def list_applicable(self, server_id, channel_id, role_ids, user_id):
-        joined = ",".join(repr(k) for k in role_ids)
+        return grants
 
-        the_query = ("SELECT _type, _flagname, _userid_or_group, _have FROM effective_permission "
-            "WHERE ( "
-            "    (_type = 300 AND _userid_or_group = ?) OR "
-            "    (_type = 250 AND _userid_or_group = ?) OR "
-            "    (_type = 200 AND _userid_or_group IN ({0})) OR "
-            "    (_type = 100 AND _userid_or_group = ?) "
-            ") ORDER BY _type").format(joined)
+    def describe(self):
+        lookups = self.hits + self.misses
 
-        k = self.connection.execute(the_query, (server_id, channel_id, user_id))
-        return [grant_t(scope, subject, flag_t(right), pm) for scope, right, subject, pm in k]
+        return "grants for {0} subjects over {1} rights, {2} resolved subjects cached, hit rate {3:.1%} of {4} lookups".format(
+            len(self.masks), len(self.names), len(self.resolved),
+            self.hits / lookups if lookups else 0, lookups)
 
-async def evaluate_access_wrapper(execute, flag, context, message, content):
-    rightsdb = context.of("auth")
+def subject_of(message):
+    """ The (server_id, channel_id, role_ids, user_id) tuple that
+        RightsDB.evaluate expects for the author of message. """
 
     if message.server is None:
         server_id = None
@@ -97,7 +237,26 @@ async def evaluate_access_wrapper(execute, flag, context, message, content):
     else:
         roles = []
 
-    if not rightsdb.evaluate(server_id, message.channel.id, roles, message.author.id, flag):
+    return (server_id, message.channel.id, roles, message.author.id)
+
+def rights_of(context, message):
+    """ The resolved rights mask of message's author. It's worked out once
+        and kept on the context, so every check made while handling the
+        message shares it. Test it with RightsDB.has. """
+
+    if context.granted_rights is None:
+        context.granted_rights = context.of("auth").resolve(*subject_of(message))
+
+    return context.granted_rights
+
+def evaluate_many(context, message, flags):
+    """ Whether the author of message has each of flags, as {flag: bool},
+        from one resolution of their rights. """
+
+    return context.of("auth").has_many(rights_of(context, message), flags)
+
+async def evaluate_access_wrapper(execute, flag, context, message, content):
+    if not evaluate_many(context, message, (flag,))[flag]:
         try:
             await context.client.add_reaction(message, "🚫")
         except discord.errors.Forbidden:
@@ -116,6 +275,8 @@ def requires_right(flag):
         See evaluate_access_wrapper. """
 
     def wrapper(exec_):
-        return partial(evaluate_access_wrapper, exec_, flag)
+        guarded = partial(evaluate_access_wrapper, exec_, flag)
+        guarded.required_right = flag
+        return guarded
 
     return wrapper
@@ -7,9 +7,18 @@ import weakref
 import auth
 import json
 import error_reporting
-import asyncio
+import prefilter
+import scheduler
+import ratelimit
+import outbound
+import coordination
+import offload
+import asyncdb
 import sys
 import os
+import time
+import traceback
+import collections
 
 def make_glue(c, f):
     async def glue(*a, **k):
@@ -17,13 +26,6 @@ def make_glue(c, f):
     glue.__name__ = f.__name__
     return glue
 
-def mention_needed_for(m):
-    # commands without attention_char or @ are allowed in 1-to-1 DMs.
-    if isinstance(m.channel, discord.PrivateChannel) and len(m.channel.recipients) == 1:
-        return 0
-
-    return 1
-
 # Sometimes messages' author property will be a User
 # instead of Member, this breaks (among other things)
 # right evaluation so add a new member property to
@@ -40,7 +42,7 @@ class SelfTerminate(BaseException):
 
 class PersonalizedContext(object):
     """ The context object passed to command executors. """
-    __slots__ = ("global_context", "client", "arg0", "message", "get_module_context", "_mc")
+    __slots__ = ("global_context", "client", "arg0", "message", "get_module_context", "_mc", "granted_rights")
 
     def __init__(self, global_context, client, for_msg, get_module_context):
         self.global_context = global_context
@@ -49,6 +51,8 @@ class PersonalizedContext(object):
         self.get_module_context = get_module_context
         self.arg0 = ""
         self._mc = None
+        # the author's resolved rights mask, filled in by auth.rights_of
+        self.granted_rights = None
 
     # semi-private methods used by Command.dispatch
 
@@ -60,6 +64,10 @@ class PersonalizedContext(object):
 
     def set_module(self, name):
         self._mc = self.global_context.module_contexts[name]
+        self.global_context.acquire_module_context(self._mc)
+
+    def release_module(self):
+        self.global_context.release_module_context(self._mc)
 
     # public methods, used by command executors
 
@@ -69,10 +77,16 @@ class PersonalizedContext(object):
         return self.get_module_context(mod_name_or_global)
 
     async def reply(self, msg=None, *, embed=None, mention=0):
+        """ Queue a message to the channel the command came from. Returns
+            a future for the sent discord.Message; you don't need to await it
+            unless you need the message. Send errors (e.g. Forbidden) are
+            not raised here: the outbound queue logs them, and they're
+            raised by awaiting the returned future. """
+
         if mention and msg:
             msg = " ".join((self.message.author.mention, msg))
 
-        return await self.client.send_message(self.message.channel, msg, embed=embed)
+        return self.global_context.outbound.send(self.message.channel, msg, embed=embed)
 
     # for convenience, we proxy all other attributes to the module context
 
@@ -87,48 +101,254 @@ class PersonalizedContext(object):
 
 class DiscordBot(object):
     LATE_EVENTS = set()
+    # config keys under these are held in memory by reload_settings
+    SETTINGS_PREFIXES = ("bot.", "scheduler.", "shed.", "ratelimit.", "outbound.", "offload.", "logdb.")
 
     @classmethod
     def event(cls, f):
         cls.LATE_EVENTS.add(f)
         return f
 
-    def __init__(self):
-        self.client = discord.Client()
+    def __init__(self, shard_id=None, shard_count=None):
+        # None when not sharded, so modules can test for "first shard"
+        # with `not bot.shard_id`
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        if shard_count is not None:
+            self.client = discord.Client(shard_id=shard_id, shard_count=shard_count)
+        else:
+            self.client = discord.Client()
         self.late_reg_events(self.client)
         # the root command has no module, so add None to prevent KeyError
         self.module_contexts = {None: None}
+        # module context -> number of commands running against it
+        self.module_context_users = weakref.WeakKeyDictionary()
+        # module context -> (future, allowance), while it's being drained
+        self.module_context_drain_waiters = {}
+        # fq module name -> future, set while the module is being swapped out
+        self.modules_reloading = {}
 
         self.rights_db = auth.RightsDB(config.get("bot.rights_db_path", "rights.db"))
         self.log_db = error_reporting.LogDB(config.get("bot.error_log_db_path", "log.db"))
 
+        self.prefilter = prefilter.MessagePrefilter()
+        self.scheduler = scheduler.CommandScheduler(self.client.loop)
+        self.rate_limiter = ratelimit.RateLimiter()
+        self.outbound = outbound.OutboundQueue(self.client)
+        self.offloader = offload.ProcessOffloader(self.client.loop)
+        offload.install(self.offloader)
+
+        for prefix in self.SETTINGS_PREFIXES:
+            config.subscribe(prefix, self.on_settings_changed)
+
         # assigned in on_ready
-        self.check_start_mention_regex = None
         self.is_ready = 0
 
-    async def init_module(self, m):
+    async def init_module(self, m, state=None):
+        """ Create and init m's context. state is a (version, snapshot)
+            pair from export_module_state, given to the new context's
+            import_state if its state_version matches. """
+
         mctx = loader.get_context_class(m)()
 
-        try:
-            await mctx.init_with_context(self)
-        except AttributeError:
-            pass
+        if state is not None:
+            self.import_module_state(m.__name__, mctx, state)
+
+        init = getattr(mctx, "init_with_context", None)
+
+        if init is not None:
+            leaf = loader.localname(m.__name__)
+            timeout = config.get("bot.module_init_timeout." + leaf,
+                config.get("bot.module_init_timeout", 30))
+
+            try:
+                await asyncio.wait_for(init(self), timeout)
+            except Exception:
+                # a timed out or failed init may have left subscriptions,
+                # fallbacks or tasks behind; let deinit undo what it can
+                await self.deinit_partial_context(m, mctx)
+                raise
 
         self.module_contexts[m.__name__] = mctx
 
-    async def uninit_module(self, m):
+    async def deinit_partial_context(self, m, mctx):
+        """ Call deinit on a context whose init didn't finish. Errors are
+            printed, not raised, so the init's own error is what's reported. """
+
+        deinit = getattr(mctx, "deinit", None)
+        if deinit is None:
+            return
+
+        print("init_module: calling deinit on", m.__name__, "after a failed init")
+        try:
+            await deinit(self)
+        except Exception:
+            print("init_module: deinit of", m.__name__, "failed too")
+            traceback.print_exc()
+
+    async def uninit_module(self, m, requester=None):
+        """ Let the commands still running against m's context finish,
+            then remove and deinit it. The context stays reachable through
+            of() until then. requester is the PersonalizedContext asking
+            for this, if any, so we don't wait for ourselves. """
+
+        mctx = self.module_contexts[m.__name__]
+        await self.drain_module_context(mctx, requester)
+
+        if self.module_contexts.get(m.__name__) is mctx:
+            del self.module_contexts[m.__name__]
+
         print("uninit_module: calling deinit on", m.__name__)
+        deinit = getattr(mctx, "deinit", None)
+        if deinit is not None:
+            await deinit(self)
+
+    async def reload_module(self, name, requester=None):
+        """ Swap a loaded module for a fresh import of its file, handing the
+            old context's exported state to the new one. Commands already
+            running finish against the old code; new dispatches wait for
+            the new context. """
+
+        fq = loader.fq_from_leaf(name)
+        old_mod = sys.modules[fq]
+        ready = self.client.loop.create_future()
+        self.modules_reloading[fq] = ready
 
         try:
-            await self.module_contexts[m.__name__].deinit(self)
-        except AttributeError:
-            pass
+            state = self.export_module_state(fq, self.module_contexts[fq])
+            loader.unload_module(name)
+
+            try:
+                mod = loader.load_module(name)
+            finally:
+                await self.uninit_module(old_mod, requester)
+
+            try:
+                await self.init_module(mod, state)
+            except Exception:
+                loader.unload_module(name)
+                raise
+        finally:
+            del self.modules_reloading[fq]
+            ready.set_result(None)
+
+        return mod
+
+    def export_module_state(self, fq, mctx):
+        export = getattr(mctx, "export_state", None)
+        if export is None:
+            return None
+
+        return (getattr(mctx, "state_version", 0), export())
+
+    def import_module_state(self, fq, mctx, state):
+        version, snapshot = state
 
-        del self.module_contexts[m.__name__]
+        if not hasattr(mctx, "import_state"):
+            return
+
+        if getattr(mctx, "state_version", 0) != version:
+            print("import_module_state: discarding state for", fq, "- schema version changed from",
+                version, "to", getattr(mctx, "state_version", 0))
+            return
+
+        mctx.import_state(snapshot)
+
+    async def wait_for_module(self, fq):
+        """ If fq is being reloaded, wait for it to finish and return 1. """
+
+        ready = self.modules_reloading.get(fq)
+        if ready is None:
+            return 0
+
+        await asyncio.shield(ready)
+        return 1
+
+    def acquire_module_context(self, mctx):
+        if mctx is not None:
+            self.module_context_users[mctx] = self.module_context_users.get(mctx, 0) + 1
+
+    def release_module_context(self, mctx):
+        if mctx is None:
+            return
+
+        users = self.module_context_users.get(mctx, 0) - 1
+
+        if users <= 0:
+            self.module_context_users.pop(mctx, None)
+        else:
+            self.module_context_users[mctx] = users
+
+        waiter = self.module_context_drain_waiters.get(mctx)
+        if waiter is not None and users <= waiter[1] and not waiter[0].done():
+            waiter[0].set_result(None)
+
+    async def drain_module_context(self, mctx, requester=None):
+        # a command reloading its own module is itself still running
+        allowance = 1 if requester is not None and requester._mc is mctx else 0
+
+        if self.module_context_users.get(mctx, 0) <= allowance:
+            return
+
+        drained = self.client.loop.create_future()
+        self.module_context_drain_waiters[mctx] = (drained, allowance)
+
+        try:
+            await asyncio.wait_for(drained, config.get("bot.module_drain_timeout", 30))
+        except asyncio.TimeoutError:
+            print("drain_module_context: gave up waiting for", self.module_context_users.get(mctx, 0),
+                "command(s) to finish")
+        finally:
+            del self.module_context_drain_waiters[mctx]
 
     async def init_modules(self):
-        for m in loader.LOADED_MODULES:
-            await self.init_module(m)
+        """ Init every loaded module. Inits run concurrently, except that a
+            module waits for the modules named in its context class's
+            init_after. Modules that fail or time out are deinited; they and
+            the modules that waited on them are reported and unloaded. """
+
+        loop = self.client.loop
+        modules = {loader.localname(m.__name__): m for m in loader.LOADED_MODULES}
+        deps = {name: [dep for dep in getattr(loader.get_context_class(m), "init_after", ())
+                       if dep in modules]
+                for name, m in modules.items()}
+        tasks = {}
+
+        for name in loader.find_dependency_cycles(deps):
+            print("init_modules: skipping", name, "because its init_after has a cycle")
+            deps[name] = None
+
+        async def init_one(name):
+            if deps[name] is None:
+                return 0
+
+            for dep in deps[name]:
+                if not await tasks[dep]:
+                    print("init_modules: skipping", name, "because", dep, "failed")
+                    return 0
+
+            t = time.time()
+            try:
+                await self.init_module(modules[name])
+            except asyncio.TimeoutError:
+                print("init_modules:", name, "timed out after {0:.3f} s".format(time.time() - t))
+                return 0
+            except Exception:
+                print("init_modules:", name, "failed after {0:.3f} s".format(time.time() - t))
+                traceback.print_exc()
+                return 0
+
+            print("init_modules:", name, "took {0:.3f} s".format(time.time() - t))
+            return 1
+
+        for name in modules:
+            tasks[name] = loop.create_task(init_one(name))
+
+        await asyncio.wait(list(tasks.values()))
+
+        for name, task in tasks.items():
+            if not task.result():
+                loader.unload_module(name)
 
     async def uninit_modules(self):
         for m in loader.LOADED_MODULES:
@@ -151,6 +371,12 @@ class DiscordBot(object):
             client.event(make_glue(self, func))
 
     async def init_modules_and_run_client(self, *args, **kwargs):
+        self.client.loop.create_task(self.scheduler.measure_loop_lag())
+        self.client.loop.create_task(asyncdb.maintain_all())
+        self.client.loop.create_task(self.log_db.run())
+        self.client.loop.create_task(self.log_db.prune_forever())
+        await coordination.connect(self.client.loop)
+        await self.rights_db.load()
         await self.init_modules()
         await self.client.start(*args, **kwargs)
 
@@ -162,6 +388,7 @@ class DiscordBot(object):
             loop.run_until_complete(self.init_modules_and_run_client(*args, **kwargs))
         except (KeyboardInterrupt, SelfTerminate):
             # https://github.com/Rapptz/discord.py/blob/async/discord/client.py#L522
+            loop.run_until_complete(self.outbound.flush())
             loop.run_until_complete(self.client.logout())
             pending = asyncio.Task.all_tasks(loop=loop)
             gathered = asyncio.gather(*pending, loop=loop)
@@ -173,6 +400,9 @@ class DiscordBot(object):
                 pass
         finally:
             loop.run_until_complete(self.uninit_modules())
+            self.offloader.shutdown()
+            loop.run_until_complete(self.log_db.close())
+            asyncdb.close_all()
             loop.close()
 
     def restart(self):
@@ -189,6 +419,30 @@ class DiscordBot(object):
 
         self.client.loop.call_soon(killer)
 
+    def on_settings_changed(self, key):
+        self.reload_settings()
+
+    def reload_settings(self):
+        """ Re-read config keys that are held in memory. """
+        self.prefilter.reload()
+        self.scheduler.reload()
+        self.rate_limiter.reload()
+        self.outbound.reload()
+        self.offloader.reload()
+        self.log_db.reload()
+        auth.reload_priorities()
+
+    async def shed(self, message):
+        """ Cheaply turn away a command we're too busy to run. """
+        self.scheduler.shed_count += 1
+        await self.turn_away(message)
+
+    async def turn_away(self, message):
+        try:
+            await self.client.add_reaction(message, "\u23f3")
+        except discord.errors.Forbidden:
+            pass
+
     # --x--
 
     def personalize(self, for_msg):
@@ -199,38 +453,37 @@ async def on_ready(context):
     print("I'm", context.client.user.name, "#", context.client.user.id)
     print("Connected to Discord at", datetime.datetime.now())
 
-    context.check_start_mention_regex = re.compile(r"<@!?{0}>".format(context.client.user.id))
+    context.prefilter.set_user(context.client.user.id)
     context.is_ready = 1
 
 @DiscordBot.event
 async def on_message(context, message):
-    if message.author.bot or \
-       message.channel.is_private and message.author.id == context.client.user.id or \
-       not context.is_ready:
-        return
-
-    has_attention = 0
-    cmd_start = 0
+    effective_content = context.prefilter.check(message)
 
-    ak = config.get("bot.attention_char", "=")
-    match = context.check_start_mention_regex.match(message.content)
-    if match:
-        cmd_start = match.end(0)
-        has_attention = 1
-    elif message.content.startswith(ak):
-        cmd_start = len(ak)
-        has_attention = 1
+    if effective_content is None:
+        return
 
-    effective_content = message.content[cmd_start:].lstrip()
+    right = loader.ROOT_COMMAND.resolve(effective_content, message).required_right
+    priority = auth.priority_of(right)
+    overloaded = context.scheduler.is_overloaded()
 
-    # TODO: should allow the prefix to be used even in DMs
-    if mention_needed_for(message) and not has_attention:
-        return
+    if priority == auth.PRIORITY_LOW and overloaded:
+        return await context.shed(message)
 
     c_ctx = context.personalize(message)
+    server_key = message.server.id if message.server else message.channel.id
+
+    # high priority commands skip the queue only while it's backed up,
+    # and only for authors who may actually run them
+    bypass = priority == auth.PRIORITY_HIGH and overloaded and \
+        context.rights_db.has(auth.rights_of(c_ctx, message), right)
 
     try:
-        await loader.ROOT_COMMAND.dispatch(c_ctx, message, effective_content)
+        await context.scheduler.run(server_key, message.author.id,
+            loader.ROOT_COMMAND.dispatch, c_ctx, message, effective_content,
+            bypass=bypass)
+    except scheduler.QueueFullError:
+        await context.turn_away(message)
     except Exception as e:
         context.log_db.log_current_error(message, e)
         raise
@@ -239,5 +492,10 @@ if __name__ == '__main__':
     import loader
     loader.load_modules()
 
-    mybot = DiscordBot()
+    # set by launcher.py when running as one of several shards
+    if os.getenv("BOT_SHARD_COUNT"):
+        mybot = DiscordBot(int(os.getenv("BOT_SHARD_ID")), int(os.getenv("BOT_SHARD_COUNT")))
+    else:
+        mybot = DiscordBot()
+
     mybot.run(config.get("client.token"), bot=config.get("client.is_bot", True))
@@ -1,7 +1,19 @@
+import auth
 import loader
+import config
+import deadlines
+
+# Bumped whenever a command is added to or removed from any tree, or a
+# module is (re)loaded. Rendered help pages are cached against it.
+TREE_VERSION = 0
+
+def bump_tree_version():
+    global TREE_VERSION
+    TREE_VERSION += 1
 
 class Command(object):
-    def __init__(self, name, *shorthands, description=None, synopsis=None, examples=None, hide=0, execution=None):
+    def __init__(self, name, *shorthands, description=None, synopsis=None, examples=None, hide=0, execution=None,
+                 deadline=None, ratelimit=None):
         self.word = name
         self.extwords = shorthands
 
@@ -9,11 +21,27 @@ class Command(object):
         self.synopsis = synopsis
         self.examples = examples
         self.is_hidden = hide
+        # seconds the executor may run for; bot.command_deadline if None
+        self.deadline = deadline
+        # {ratelimit.SCOPE_*: (capacity, period)}, see ratelimit.RateLimiter
+        self.ratelimit = ratelimit
+        self.parent = None
 
         self.sub_dispatch_table = {}
+        # shorthand -> Command, kept in sync by register/delete_subcommand
+        # so lookup never has to walk sub_dispatch_table.
+        self.alias_table = {}
+        # (claims, Command): words no subcommand matches go to the Command
+        # if claims(word, message) is true. See set_fallback.
+        self.fallback = None
 
         self.execute = self.get_function_body(execution)
         self.provider = loader.LOADING_MODULE
+        # set by auth.requires_right, used to filter help output
+        self.required_right = getattr(self.execute, "required_right", None)
+
+        self.help_cache = {}
+        self.help_cache_version = TREE_VERSION
 
     def get_function_body(self, callable_):
         if isinstance(callable_, Command):
@@ -21,41 +49,142 @@ class Command(object):
         else:
             return callable_
 
-    def has_subcommands(self):
-        cmd_count = len(self.sub_dispatch_table)
-
+    def has_subcommands(self, hidden_rights=frozenset()):
         for cmd_struct in self.sub_dispatch_table.values():
-            if cmd_struct.is_hidden:
-                cmd_count -= 1
+            if not (cmd_struct.is_hidden or cmd_struct.required_right in hidden_rights):
+                return 1
+
+        return 0
+
+    def qualified_name(self):
+        """ The full words (not shorthands) leading to this command. """
+        if self.parent is None or not self.parent.word:
+            return self.word
 
-        return cmd_count > 0
+        return " ".join((self.parent.qualified_name(), self.word))
+
+    def subcommand_rights(self):
+        """ The set of rights required by this command's direct subcommands. """
+        return {cmd_struct.required_right
+                for cmd_struct in self.sub_dispatch_table.values()
+                if cmd_struct.required_right is not None}
 
     def is_subcommand_or_alias(self, name):
-        for cmd_struct in self.sub_dispatch_table.values():
-            if name == cmd_struct.word or name in cmd_struct.extwords:
-                return 1
+        return 1 if self.lookup(name) is not None else 0
 
-        return 0
+    def lookup(self, word):
+        """ Find the subcommand for a word or shorthand. Full words take
+            priority over shorthands. """
+        return self.sub_dispatch_table.get(word) or self.alias_table.get(word)
+
+    def lookup_fallback(self, word, message):
+        if self.fallback is not None and self.fallback[0](word, message):
+            return self.fallback[1]
+
+        return None
+
+    def resolve(self, content, message):
+        """ Return the command that dispatch would end up running for
+            content, without running anything. """
+
+        cmd = self
+        nargs = content.split(maxsplit=1)
 
-    def register_subcommand(self, name, *shorthands, description=None, synopsis=None, examples=None, hide=0, execution=None):
+        while nargs:
+            nc = cmd.lookup(nargs[0]) or cmd.lookup_fallback(nargs[0], message)
+
+            if nc is None:
+                break
+
+            cmd = nc
+            nargs = nargs[1].split(maxsplit=1) if len(nargs) == 2 else []
+
+        return cmd
+
+    def index_aliases(self, cmd):
+        for alias in cmd.extwords:
+            owner = self.alias_table.get(alias)
+
+            if owner is not None and owner is not cmd:
+                print("index_aliases: '{0}' is already a shorthand for '{1}', not binding it to '{2}'".format(
+                    alias, owner.word, cmd.word))
+                continue
+
+            if alias in self.sub_dispatch_table:
+                print("index_aliases: shorthand '{0}' of '{1}' is shadowed by a command with that name".format(
+                    alias, cmd.word))
+
+            self.alias_table[alias] = cmd
+
+    def unindex_aliases(self, cmd):
+        freed = [alias for alias in cmd.extwords if self.alias_table.get(alias) is cmd]
+
+        for alias in freed:
+            del self.alias_table[alias]
+
+        # a shorthand refused earlier may now be claimable by someone else
+        for alias in freed:
+            for other in self.sub_dispatch_table.values():
+                if other is not cmd and alias in other.extwords:
+                    self.alias_table[alias] = other
+                    break
+
+    def register_subcommand(self, name, *shorthands, description=None, synopsis=None, examples=None, hide=0, execution=None,
+                            deadline=None, ratelimit=None):
         cmd = Command(name, *shorthands,
             description=description,
             synopsis=synopsis,
             examples=examples,
             hide=hide,
-            execution=execution)
+            execution=execution,
+            deadline=deadline,
+            ratelimit=ratelimit)
+        cmd.parent = self
+
+        if name in self.alias_table:
+            print("register_subcommand: '{0}' shadows a shorthand for '{1}'".format(
+                name, self.alias_table[name].word))
+
+        self.delete_subcommand(name)
         self.sub_dispatch_table[name] = cmd
+        self.index_aliases(cmd)
+        bump_tree_version()
         return cmd
 
-    def subcommand(self, name, *shorthands, description=None, synopsis=None, examples=None, hide=0):
+    def subcommand(self, name, *shorthands, description=None, synopsis=None, examples=None, hide=0, deadline=None,
+                   ratelimit=None):
         def wrapper(f):
-            cmd = self.register_subcommand(name, *shorthands, description=description, synopsis=synopsis, examples=examples, hide=hide, execution=f)
+            cmd = self.register_subcommand(name, *shorthands, description=description, synopsis=synopsis, examples=examples, hide=hide, execution=f,
+                deadline=deadline, ratelimit=ratelimit)
             return cmd
         return wrapper
 
+    def set_fallback(self, name, claims, execution, provider=None):
+        """ Send words that don't match any subcommand to execution, if
+            claims(word, message) says so. Use this instead of registering a
+            Command per word when the set of words is large or changes at
+            runtime. name is only used for help and ratelimit config keys. """
+
+        cmd = Command(name, hide=1, execution=execution)
+        cmd.parent = self
+
+        if provider is not None:
+            cmd.provider = provider
+
+        self.fallback = (claims, cmd)
+        bump_tree_version()
+        return cmd
+
+    def clear_fallback(self):
+        if self.fallback is not None:
+            self.fallback = None
+            bump_tree_version()
+
     def delete_subcommand(self, word):
         if word in self.sub_dispatch_table:
-            del self.sub_dispatch_table[word]
+            cmd = self.sub_dispatch_table.pop(word)
+            self.unindex_aliases(cmd)
+            bump_tree_version()
 
     async def dispatch(self, context, message, effective_content):
         nargs = effective_content.split(maxsplit=1)
@@ -64,13 +193,7 @@ class Command(object):
             next_word = nargs.pop(0)
             next_ec = nargs.pop() if nargs else ""
 
-            nc = self.sub_dispatch_table.get(next_word)
-
-            if nc is None:
-                for cmd_struct in self.sub_dispatch_table.values():
-                    if next_word in cmd_struct.extwords:
-                        nc = cmd_struct
-                        break
+            nc = self.lookup(next_word) or self.lookup_fallback(next_word, message)
         else:
             nc = None
 
@@ -79,16 +202,49 @@ class Command(object):
 
             await nc.dispatch(context, message, next_ec)
         elif self.execute:
+            if await context.global_context.wait_for_module(self.provider):
+                # we're a command of the old copy of the module, so go
+                # through the tree again to find the reloaded one
+                if effective_content:
+                    effective_content = " ".join((context.arg0, effective_content))
+                else:
+                    effective_content = context.arg0
+
+                context.arg0 = ""
+                return await loader.ROOT_COMMAND.dispatch(context, message, effective_content)
+
             context.set_module(self.provider)
-            print("dispatch: executing", message.content, "in", message.channel.name)
+
             try:
-                await self.execute(context, message, effective_content)
-            except Exception as error:
-                await self.on_unhandled_exception(context, message, effective_content, error)
-                raise
+                await self.run_executor(context, message, effective_content)
+            finally:
+                context.release_module()
         else:
             await self.default_implementation(context, message, effective_content)
 
+    def is_permitted(self, context, message):
+        if self.required_right is None:
+            return 1
+
+        return context.of("auth").has(auth.rights_of(context, message), self.required_right)
+
+    async def run_executor(self, context, message, effective_content):
+        # authors without the right are turned away by requires_right
+        # inside execute; they shouldn't use up the shared buckets first
+        if self.is_permitted(context, message) and \
+                not context.global_context.rate_limiter.admit(self, message):
+            return await self.on_throttled(context, message, effective_content)
+
+        print("dispatch: executing", message.content, "in", message.channel.name)
+        try:
+            with deadlines.budget(self.deadline or config.get("bot.command_deadline", 60)):
+                await self.execute(context, message, effective_content)
+        except deadlines.DeadlineExceeded:
+            await self.on_deadline_exceeded(context, message, effective_content)
+        except Exception as error:
+            await self.on_unhandled_exception(context, message, effective_content, error)
+            raise
+
     def __repr__(self):
         return "<Command '{0.word}' aka {0.extwords} :{0.sub_dispatch_table} from {0.provider}>".format(self)
 
@@ -102,6 +258,20 @@ class Command(object):
         except Exception:
             pass
 
+    async def on_throttled(self, context, message, content):
+        try:
+            await context.client.add_reaction(message, "\u23f1")
+        except Exception:
+            pass
+
+    async def on_deadline_exceeded(self, context, message, content):
+        print("dispatch: deadline exceeded for", message.content)
+
+        try:
+            await context.reply("That took too long, so I gave up. Please try again in a bit, nya.", mention=1)
+        except Exception:
+            pass
+
     async def default_implementation(self, context, message, content):
         """ Reply with a help message. The content depends on whether you
             specified description, synopsis, examples, etc. """
@@ -116,23 +286,44 @@ class Command(object):
 
         await context.reply(header)
 
-    def help_message(self, context):
+    def help_message(self, context, hidden_rights=frozenset()):
+        """ Render help for this command under its full name, whatever
+            shorthands it was asked for by. Subcommands requiring a right
+            in hidden_rights are left out. Pages are cached per set of
+            hidden rights (so at most one per subset of
+            subcommand_rights()) until the command tree changes. """
+
+        if self.help_cache_version != TREE_VERSION:
+            self.help_cache = {}
+            self.help_cache_version = TREE_VERSION
+
+        key = frozenset(hidden_rights)
+        page = self.help_cache.get(key)
+
+        if page is None:
+            page = self.render_help_message(self.qualified_name(), key)
+            self.help_cache[key] = page
+
+        return page
+
+    def render_help_message(self, arg0, hidden_rights):
         msg = []
+        has_subcommands = self.has_subcommands(hidden_rights)
 
         if self.description:
             if self.synopsis:
-                msg.append("`{1} {0.synopsis}`: {0.description}\n".format(self, context.arg0))
+                msg.append("`{1} {0.synopsis}`: {0.description}\n".format(self, arg0))
             else:
-                msg.append("`{1}`: {0.description}\n".format(self, context.arg0))
-        elif not self.has_subcommands():
+                msg.append("`{1}`: {0.description}\n".format(self, arg0))
+        elif not has_subcommands:
             msg.append("No help message available for this command.")
 
         if self.execute and self.examples:
             msg.append("**Examples**:")
             for eg in self.examples:
-                msg.append("- `{0} {1}`".format(context.arg0, eg))
+                msg.append("- `{0} {1}`".format(arg0, eg))
 
-        if self.has_subcommands():
+        if has_subcommands:
             if self.word:
                 msg.append("**Subcommands**:")
             else:
@@ -141,10 +332,10 @@ class Command(object):
             for k in sorted(self.sub_dispatch_table.keys()):
                 cmd_struct = self.sub_dispatch_table[k]
 
-                if cmd_struct.is_hidden:
+                if cmd_struct.is_hidden or cmd_struct.required_right in hidden_rights:
                     continue
 
-                st = "- {0} **{1}**".format(context.arg0, cmd_struct.word)
+                st = "- {0} **{1}**".format(arg0, cmd_struct.word)
                 if cmd_struct.synopsis:
                     st += " `{0}`".format(cmd_struct.synopsis)
                 if cmd_struct.description:
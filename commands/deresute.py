@@ -1,7 +1,8 @@
 import deresdata
 import json
 import discord
-import sqlite3
+import asyncdb
+import storage
 import time
 import sys
 import pytz
@@ -10,7 +11,11 @@ from datetime import datetime, timedelta
 from collections import namedtuple
 
 import loader
+import config
 import auth
+import reply_cache
+import ratelimit
+import offload
 
 JST = pytz.timezone("Asia/Tokyo")
 
@@ -28,23 +33,26 @@ class IDNotDeletedError(Exception):
 class IDInvalidError(Exception):
     pass
 
+GAMEIDS_MIGRATIONS = [
+    """CREATE TABLE IF NOT EXISTS
+        gameids_v1 (
+            _gameid TEXT,
+            _originator TEXT,
+            _name TEXT,
+            _lower TEXT
+        )
+    """,
+    storage.dedupe("gameids_v1", "_lower") + """;
+    CREATE UNIQUE INDEX gameids_v1_lower ON gameids_v1 (_lower)
+    """,
+]
+
 class FriendDB(object):
     def __init__(self):
-        connection = sqlite3.connect("drst_game_ids.db")
-        connection.execute("""CREATE TABLE IF NOT EXISTS
-            gameids_v1 (
-                _gameid TEXT,
-                _originator TEXT,
-                _name TEXT,
-                _lower TEXT
-            )
-        """)
-        connection.commit()
-
-        self.connection = connection
-
-    def set_id_for_name(self, name, id, originator):
-        if self.get_id_for_name(name):
+        self.db = asyncdb.open_database("drst_game_ids.db", GAMEIDS_MIGRATIONS)
+
+    async def set_id_for_name(self, name, id, originator):
+        if await self.get_id_for_name(name):
             raise IDAlreadyExistsError()
 
         if name.isdigit():
@@ -53,23 +61,19 @@ class FriendDB(object):
         if not id.isdigit():
             raise IDInvalidError()
 
-        self.connection.execute("INSERT INTO gameids_v1 VALUES (?, ?, ?, ?)", (id, originator, name, name.lower()))
-        self.connection.commit()
+        await self.db.execute("INSERT INTO gameids_v1 VALUES (?, ?, ?, ?)", (id, originator, name, name.lower()))
 
-    def delete_name(self, name):
-        self.connection.execute("DELETE FROM gameids_v1 WHERE _lower = ?", (name.lower(),))
-        self.connection.commit()
+    async def delete_name(self, name):
+        await self.db.execute("DELETE FROM gameids_v1 WHERE _lower = ?", (name.lower(),))
 
-    def delete_name_safe(self, name, originator):
-        k = self.connection.execute("DELETE FROM gameids_v1 WHERE _lower = ? AND _originator = ?", (name.lower(), originator))
+    async def delete_name_safe(self, name, originator):
+        k = await self.db.execute("DELETE FROM gameids_v1 WHERE _lower = ? AND _originator = ?", (name.lower(), originator))
 
-        if k.rowcount == 0:
+        if k == 0:
             raise IDNotDeletedError()
-        else:
-            self.connection.commit()
 
-    def get_id_for_name(self, name):
-        k = self.connection.execute("SELECT _gameid FROM gameids_v1 WHERE _lower = ?", (name.lower(),)).fetchone()
+    async def get_id_for_name(self, name):
+        k = await self.db.query_one("SELECT _gameid FROM gameids_v1 WHERE _lower = ?", (name.lower(),))
 
         if k is None:
             return None
@@ -79,6 +83,9 @@ class FriendDB(object):
 @loader.context_class
 class DeresuteModuleContext(object):
     truth_version_timeout_t = namedtuple("truth_version_timeout_t", ("version", "checktime"))
+    # config keys EventReader reads when it's created
+    TWITTER_KEYS = {"deresute.app_key", "deresute.app_secret", "deresute.token", "deresute.token_secret"}
+
     def __init__(self):
         self.frienddb = FriendDB()
         self.event = deresdata.EventReader()
@@ -86,6 +93,32 @@ class DeresuteModuleContext(object):
         self.cur_truth = self.truth_version_timeout_t("", 0)
         self.last_lookup_card_ent = None
 
+        config.subscribe("deresute.", self.on_config_changed)
+
+    async def deinit(self, bot):
+        config.unsubscribe("deresute.", self.on_config_changed)
+
+    def on_config_changed(self, key):
+        if key in self.TWITTER_KEYS:
+            self.event = deresdata.EventReader()
+
+    # bump when the shape of export_state's snapshot changes
+    state_version = 1
+
+    def export_state(self):
+        """ Plain tuples only, so the snapshot doesn't hold on to classes
+            from the copy of the module being unloaded. """
+
+        card = tuple(self.last_lookup_card_ent) if self.last_lookup_card_ent is not None else None
+        return (tuple(self.cur_truth), card)
+
+    def import_state(self, snapshot):
+        truth, card = snapshot
+
+        self.cur_truth = self.truth_version_timeout_t(*truth)
+        if card is not None:
+            self.last_lookup_card_ent = deresdata.ark.filterable_card_data_t(*card)
+
     async def get_current_truth_version(self):
         if time.time() - self.cur_truth.checktime >= 3600:
             api_info = await deresdata.cfetch("https://starlight.kirara.ca/api/v1/info")
@@ -101,7 +134,9 @@ DERESUTE = loader.register_command("deresute", "drst", "dere", "ss",
 @DERESUTE.subcommand("card",
     description="Show details for a certain card.",
     synopsis="[search terms...]",
-    examples=["syuko2", "event mayu", "ssr riina"])
+    examples=["syuko2", "event mayu", "ssr riina"],
+    deadline=45,
+    ratelimit={ratelimit.SCOPE_USER: (4, 60), ratelimit.SCOPE_CHANNEL: (10, 60)})
 @auth.requires_right(P_DERESUTE_PUBLIC)
 async def card(context, message, content):
     await context.client.send_typing(message.channel)
@@ -112,18 +147,18 @@ async def card(context, message, content):
 
         fc = context.last_lookup_card_ent
     else:
-        if deresdata.needs_update(await context.get_current_truth_version()):
+        if await deresdata.needs_update(await context.get_current_truth_version()):
             await context.reply("I need to rebuild the index, nya. I'll find your card in a few seconds...", mention=1)
             await deresdata.build_ark()
 
         try:
-            query = deresdata.parse_query(content)
-            results = deresdata.exec_query(query)
+            results = await offload.run(deresdata.search, content)
         except deresdata.InvalidQueryError as error:
-            return await context.client.send_message(message.channel, "{0} {1}".format(
-                message.author.mention,
-                str(error)
-            ))
+            return await context.reply(str(error), mention=1)
+        except offload.OffloadBusyError:
+            return await context.reply("I'm too busy to search right now, nya. Try again in a few seconds.", mention=1)
+        except asyncio.TimeoutError:
+            return await context.reply("Timed out. Please try again in a few seconds.", mention=1)
 
         if not results:
             return await context.reply("There aren't any cards matching your search, nya.", mention=1)
@@ -179,22 +214,24 @@ async def card_image(context, message, content):
         fc = context.last_lookup_card_ent
         want_awakened = 0
     else:
-        if deresdata.needs_update(await context.get_current_truth_version()):
+        if await deresdata.needs_update(await context.get_current_truth_version()):
             await context.reply("I need to rebuild the index, nya. I'll find your card in a few seconds...", mention=1)
             await deresdata.build_ark()
 
         try:
-            query = deresdata.parse_query(content)
-            results = deresdata.exec_query(query)
+            results, want_awakened = await offload.run(deresdata.search_awake, content)
         except deresdata.InvalidQueryError as error:
             return await context.reply(str(error), mention=1)
+        except offload.OffloadBusyError:
+            return await context.reply("I'm too busy to search right now, nya. Try again in a few seconds.", mention=1)
+        except asyncio.TimeoutError:
+            return await context.reply("Timed out. Please try again in a few seconds.", mention=1)
 
         if not results:
             return await context.reply("There aren't any cards matching your search, nya.", mention=1)
         else:
             fc = results[0]
             context.last_lookup_card_ent = fc
-            want_awakened = query.is_awake
 
     if fc.rarity < 5 and image_class in {"image", "pic"}:
         image_class = "cardimage"
@@ -218,7 +255,9 @@ async def card_image(context, message, content):
         await context.reply("https://hoshimoriuta.kirara.ca/{1}/{0}.png".format(use_id, im_class))
 
 @DERESUTE.subcommand("whatsnew",
-    description="Display the latest update.")
+    description="Display the latest update.",
+    deadline=45,
+    ratelimit={ratelimit.SCOPE_USER: (1, 300), ratelimit.SCOPE_SERVER: (2, 300)})
 @auth.requires_right(P_DERESUTE_NOISY)
 async def whatsnew(context, message, content):
     context.client.send_typing(message.channel)
@@ -306,7 +345,8 @@ def embed_from_card_json(c1, c2, tl_dictionary):
 
 # -x-  ADMIN COMMANDS  -x-
 
-@DERESUTE.subcommand("buildkeywords", "bw")
+@DERESUTE.subcommand("buildkeywords", "bw", deadline=300,
+    ratelimit={ratelimit.SCOPE_USER: (1, 600)})
 @auth.requires_right(P_DERESUTE_ADMIN)
 async def adm_buildkeywords(context, message, content):
     kwresult = await deresdata.build_keywords()
@@ -338,7 +378,7 @@ async def get_id(context, message, content):
         return await context.reply("https://deresute.me/{0}/medium.png?{1}".format(
             content, time.time()))
 
-    the_id = context.frienddb.get_id_for_name(content)
+    the_id = await context.frienddb.get_id_for_name(content)
     if the_id is not None:
         return await context.reply("https://deresute.me/{0}/medium.png?{1}".format(
             the_id, time.time()))
@@ -355,7 +395,7 @@ async def add_id(context, message, content):
         return await context.reply("Provide a name and ID.")
 
     try:
-        context.frienddb.set_id_for_name(args[0], args[1], message.author.id)
+        await context.frienddb.set_id_for_name(args[0], args[1], message.author.id)
     except IDAlreadyExistsError:
         await context.reply("Name is already in use. `del` it and try again.")
     except NameNeedsOneOrMoreNonNumbersError:
@@ -374,7 +414,7 @@ async def add_id(context, message, content):
 @auth.requires_right(P_DERESUTE_PUBLIC)
 async def del_id_safe(context, message, content):
     try:
-        context.frienddb.delete_name_safe(content, message.author.id)
+        await context.frienddb.delete_name_safe(content, message.author.id)
     except IDNotDeletedError:
         await context.reply("Name wasn't deleted. Are you sure it belongs to you?")
     else:
@@ -388,7 +428,7 @@ async def del_id_safe(context, message, content):
     synopsis="[name]")
 @auth.requires_right(P_DERESUTE_ADMIN)
 async def del_id_notsafe(context, message, content):
-    context.frienddb.delete_name(content)
+    await context.frienddb.delete_name(content)
 
     try:
         await context.client.add_reaction(message, "\u2705")
@@ -398,8 +438,10 @@ async def del_id_notsafe(context, message, content):
 # -x- Events
 
 @DERESUTE.subcommand("event", "tiers", "cutoffs", "e", "border",
-    description="Current event cutoffs.")
+    description="Current event cutoffs.",
+    deadline=30)
 @auth.requires_right(P_DERESUTE_CUTOFFS)
+@reply_cache.cached_reply(60)
 async def get_event(context, message, content):
     try:
         the_event = await context.event.get_current()
@@ -419,12 +461,17 @@ async def get_event(context, message, content):
     except deresdata.NoDataCurrentlyAvailableError:
         embed.colour = 0xCCCC00
         embed.set_footer(text="It's currently too early to show cutoff data. Try again in an hour.")
+    except asyncio.TimeoutError:
+        embed.colour = 0xCCCC00
+        embed.set_footer(text="Cutoff data took too long to load. Try again in a few minutes.")
 
     await context.reply(embed=embed)
 
 @DERESUTE.subcommand("prediction", "predict", "p",
-    description="Current event predictions.")
+    description="Current event predictions.",
+    deadline=30)
 @auth.requires_right(P_DERESUTE_CUTOFFS)
+@reply_cache.cached_reply(120)
 async def get_event_prediction(context, message, content):
     try:
         prediction = await context.event.get_latest_prediction()
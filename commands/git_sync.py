@@ -5,6 +5,7 @@ import os
 import hashlib
 import sh
 import config
+import ratelimit
 
 class DirectorySnapshot(object):
     def __init__(self, from_):
@@ -39,10 +40,15 @@ class DirectorySnapshot(object):
 
 P_SELF_UPDATE = auth.declare_right("SELF_UPDATE")
 ESSENTIAL_FILES = ["auth.py", "bot.py", "command_object.py", "config.py", "error_reporting.py",
-    "loader.py"]
+    "loader.py", "prefilter.py", "scheduler.py", "deadlines.py",
+    "reply_cache.py", "ratelimit.py",
+    "outbound.py", "coordination.py", "launcher.py", "offload.py",
+    "asyncdb.py", "storage.py"]
 
 @loader.command("sync",
-    description="Update from a configured git repository.")
+    description="Update from a configured git repository.",
+    deadline=300,
+    ratelimit={ratelimit.SCOPE_USER: (1, 60)})
 @auth.requires_right(P_SELF_UPDATE)
 async def sync_command(context, message, content):
     if not content:
@@ -1,5 +1,6 @@
 import loader
 import config
+import auth
 
 @loader.command("help",
     description="Display commands' help messages.")
@@ -21,26 +22,22 @@ async def help(context, message, content):
     while words:
         w = words.pop()
 
-        if w in inspect_cmd.sub_dispatch_table:
-            inspect_cmd = inspect_cmd.sub_dispatch_table[w]
-            valid_words.append(w)
-            continue
-        else:
-            for child in inspect_cmd.sub_dispatch_table.values():
-                if w in child.extwords:
-                    inspect_cmd = child
-                    valid_words.append(w)
-                    break
-            else:
-                # no command
-                return await no_such_command(w)
-
-            # if we got here it means we found a command and broke
-            # out of the inner for
-            continue
+        child = inspect_cmd.lookup(w)
+
+        if child is None:
+            return await no_such_command(w)
+
+        inspect_cmd = child
+        valid_words.append(w)
+
+    if config.get("help.filter_by_rights", 0):
+        allowed = auth.evaluate_many(context, message, inspect_cmd.subcommand_rights())
+        hidden_rights = frozenset(flag for flag, granted in allowed.items() if not granted)
+    else:
+        hidden_rights = frozenset()
 
     context.arg0 = content
-    await context.reply(inspect_cmd.help_message(context))
+    await context.reply(inspect_cmd.help_message(context, hidden_rights))
 
 @loader.command("source", "code")
 async def source(context, message, text):
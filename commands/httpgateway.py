@@ -1,27 +1,87 @@
 import loader
+import asyncio
 import aiohttp.web
 import weakref
 import discord
 import config
+import coordination
 
 @loader.context_class
 class HttpGateway(object):
+    """ Only shard 0 listens, since every shard would want the same port.
+        Messages for channels it doesn't have are published to the other
+        shards, and whichever has the channel sends them. """
+
     async def init_with_context(self, bot):
-        event_loop = bot.client.loop
+        self.event_loop = bot.client.loop
+        self.bot_ref = weakref.proxy(bot)
+        self.serving = not bot.shard_id
+        coordination.subscribe(coordination.TOPIC_GATEWAY, self.on_relayed_message)
+
+        if not self.serving:
+            return
+
         self.app = aiohttp.web.Application()
         self.app.router.add_post("/msg", self.recv_msg)
 
+        self.handler = self.app.make_handler()
+        self.service = None
+        # changes to httpgateway.* are applied by one restart task at a time
+        self.restart_lock = asyncio.Lock()
+        self.restart_task = None
+        self.restart_pending = 0
+        await self.start_server()
+
+        config.subscribe("httpgateway.", self.on_config_changed)
+
+    async def start_server(self):
         http_config_host = config.get("httpgateway.host", "0.0.0.0")
         http_config_port = config.get("httpgateway.port", 8002)
 
-        self.handler = self.app.make_handler()
-        self.service = await event_loop.create_server(self.handler, http_config_host, http_config_port)
+        self.service = await self.event_loop.create_server(self.handler, http_config_host, http_config_port)
 
-        self.bot_ref = weakref.proxy(bot)
+    async def stop_server(self):
+        if self.service is not None:
+            self.service.close()
+            await self.service.wait_closed()
+            self.service = None
+
+    async def restart_server(self):
+        """ Restart until no change is left unapplied. Waits
+            httpgateway.restart_delay seconds first, so that host and port
+            written one after the other cause a single restart. """
+
+        while self.restart_pending:
+            await asyncio.sleep(config.get("httpgateway.restart_delay", 1))
+            self.restart_pending = 0
+
+            async with self.restart_lock:
+                await self.stop_server()
+                try:
+                    await self.start_server()
+                except OSError as e:
+                    print("HttpGateway: can't listen on {0}:{1}: {2!r}".format(
+                        config.get("httpgateway.host", "0.0.0.0"), config.get("httpgateway.port", 8002), e))
+
+    def on_config_changed(self, key):
+        self.restart_pending = 1
+
+        if self.restart_task is None or self.restart_task.done():
+            self.restart_task = self.event_loop.create_task(self.restart_server())
 
     async def deinit(self, bot):
-        self.service.close()
-        await self.service.wait_closed()
+        coordination.unsubscribe(coordination.TOPIC_GATEWAY, self.on_relayed_message)
+
+        if not self.serving:
+            return
+
+        config.unsubscribe("httpgateway.", self.on_config_changed)
+
+        if self.restart_task is not None:
+            self.restart_task.cancel()
+
+        async with self.restart_lock:
+            await self.stop_server()
         await self.app.shutdown()
         await self.handler.shutdown(60.0)
         await self.app.cleanup()
@@ -32,12 +92,25 @@ class HttpGateway(object):
             host, port = peername
 
         payload = await request.json()
+        title = "Message from {0}:{1}".format(host, port)
         target = self.bot_ref.client.get_channel(payload["target"])
 
+        if target is None:
+            coordination.publish(coordination.TOPIC_GATEWAY,
+                {"target": payload["target"], "title": title, "text": payload["text"]})
+        else:
+            await self.send(target, title, payload["text"])
+
+        return aiohttp.web.Response(text="OK")
+
+    async def send(self, target, title, text):
         embed = discord.Embed(type="rich")
-        embed.add_field(name="Message from {0}:{1}".format(host, port),
-                        value=payload["text"])
+        embed.add_field(name=title, value=text)
 
         await self.bot_ref.client.send_message(target, embed=embed)
 
-        return aiohttp.web.Response(text="OK")
+    def on_relayed_message(self, payload):
+        target = self.bot_ref.client.get_channel(payload["target"])
+
+        if target is not None:
+            self.event_loop.create_task(self.send(target, payload["title"], payload["text"]))
@@ -6,11 +6,15 @@ import config
 import json
 import discord
 import os
+import re
 import binascii
+import outbound
+import time
 
 P_MANAGE_CONFIG = auth.declare_right("MANAGE_CONFIG")
 P_MANAGE_MODULES = auth.declare_right("MANAGE_MODULES")
 P_EVAL_CODE = auth.declare_right("EVAL_CODE")
+P_VIEW_STATUS = auth.declare_right("VIEW_STATUS")
 
 mod = loader.register_command("mod", "m",
     description="Load, reload, and unload command modules.")
@@ -26,14 +30,8 @@ async def reload_mod(context, message, content):
 
     bot = context.of("discordbot")
 
-    mod = sys.modules[fq]
-    loader.unload_module(content)
-    await bot.uninit_module(mod)
-    del mod
-
     try:
-        mod = loader.load_module(content)
-        await bot.init_module(mod)
+        await bot.reload_module(content, context)
     except Exception as e:
         await context.reply("Loading '{0}' failed with a {1}. Fix it and `load` the module again.".format(
             content, e.__class__.__name__))
@@ -48,12 +46,15 @@ async def unload_mod(context, message, content):
     fq = loader.fq_from_leaf(content)
 
     if fq not in sys.modules:
+        if loader.remove_stubs(content):
+            return await context.reply("\u2705")
+
         return await context.reply("It's not loaded, nya.")
 
     bot = context.of("discordbot")
     mod = sys.modules[fq]
     loader.unload_module(content)
-    await bot.uninit_module(mod)
+    await bot.uninit_module(mod, context)
     del mod
 
     await context.reply("\u2705")
@@ -98,10 +99,38 @@ config_command = loader.register_command("config", "cf",
     description="Write configuration variables.")
 sensitive_keys = {"client.token"}
 
-@config_command.subcommand("write", "w")
+channel_mention_regex = re.compile("<#([0-9]+)>")
+
+def config_scope(message, word):
+    """ Parse the optional scope argument of config write/unset into
+        (scope, subject). Returns (None, None) if word isn't a scope. """
+
+    if word == "'server" and message.server:
+        return (config.SCOPE_SERVER, message.server.id)
+    elif word == "'channel":
+        return (config.SCOPE_CHANNEL, message.channel.id)
+    elif word.startswith("~s") and word[2:]:
+        return (config.SCOPE_SERVER, word[2:])
+    elif word.startswith("~c") and word[2:]:
+        return (config.SCOPE_CHANNEL, word[2:])
+
+    match = channel_mention_regex.match(word)
+    if match:
+        return (config.SCOPE_CHANNEL, match.group(1))
+
+    return (None, None)
+
+@config_command.subcommand("write", "w",
+    description="Write a configuration variable, optionally only for one server or channel.",
+    synopsis="['server | 'channel | #channel | ~s[server id] | ~c[channel id]] [key] [JSON value]")
 @auth.requires_right(P_MANAGE_CONFIG)
 async def config_write(context, message, text):
     args = text.split(maxsplit=1)
+    scope, subject = config_scope(message, args[0]) if args else (None, None)
+
+    if scope is not None:
+        args = args[1].split(maxsplit=1) if len(args) == 2 else []
+
     if len(args) != 2:
         return await context.reply("A value must be specified.")
 
@@ -115,9 +144,190 @@ async def config_write(context, message, text):
     except ValueError:
         return await context.reply("The content is not valid JSON.")
 
-    config.write_direct(key, value)
+    if scope is None:
+        config.write_direct(key, value)
+    else:
+        config.write_scoped_direct(scope, subject, key, value)
+
+    try:
+        await context.client.add_reaction(message, "\u2705")
+    except discord.errors.Forbidden:
+        await context.reply("\u2705")
+
+@config_command.subcommand("unset",
+    description="Remove a server or channel override of a configuration variable.",
+    synopsis="['server | 'channel | #channel | ~s[server id] | ~c[channel id]] [key]")
+@auth.requires_right(P_MANAGE_CONFIG)
+async def config_unset(context, message, text):
+    args = text.split()
+    scope, subject = config_scope(message, args[0]) if args else (None, None)
+
+    if scope is None or len(args) != 2:
+        return await context.reply("A scope and a key must be specified.")
+
+    config.delete_scoped(scope, subject, args[1])
+
+    try:
+        await context.client.add_reaction(message, "\u2705")
+    except discord.errors.Forbidden:
+        await context.reply("\u2705")
+
+def ignore_target(message, text):
+    """ Parse a target for config ignore/unignore into (config key, id).
+        Accepts 'server, #channel, ~s[server id], and ~c[channel id]. """
+
+    text = text.strip()
+
+    if text == "'server" and message.server:
+        return ("bot.ignored_servers", message.server.id)
+    elif text.startswith("~s") and text[2:]:
+        return ("bot.ignored_servers", text[2:])
+    elif text.startswith("~c") and text[2:]:
+        return ("bot.ignored_channels", text[2:])
+
+    match = channel_mention_regex.match(text)
+    if match:
+        return ("bot.ignored_channels", match.group(1))
+
+    return (None, None)
+
+@config_command.subcommand("ignore",
+    description="Stop responding to commands in a channel or server.",
+    synopsis="['server | #channel | ~s[server id] | ~c[channel id]]")
+@auth.requires_right(P_MANAGE_CONFIG)
+async def config_ignore(context, message, text):
+    key, subject = ignore_target(message, text)
+
+    if key is None:
+        return await context.reply("Ignore target invalid, nya.")
+
+    ignored = config.get(key, [])
+    if subject not in ignored:
+        config.write(key, list(ignored) + [subject])
+
+    try:
+        await context.client.add_reaction(message, "\u2705")
+    except discord.errors.Forbidden:
+        await context.reply("\u2705")
+
+@config_command.subcommand("unignore",
+    description="Respond to commands in a channel or server again.",
+    synopsis="['server | #channel | ~s[server id] | ~c[channel id]]")
+@auth.requires_right(P_MANAGE_CONFIG)
+async def config_unignore(context, message, text):
+    key, subject = ignore_target(message, text)
+
+    if key is None:
+        return await context.reply("Ignore target invalid, nya.")
+
+    config.write(key, [k for k in config.get(key, []) if k != subject])
 
     try:
         await context.client.add_reaction(message, "\u2705")
     except discord.errors.Forbidden:
         await context.reply("\u2705")
+
+status_command = loader.register_command("status",
+    description="Show runtime statistics.")
+
+@status_command.subcommand("prefilter",
+    description="How many messages were dropped before dispatch, and why.")
+@auth.requires_right(P_VIEW_STATUS)
+async def status_prefilter(context, message, text):
+    stats = context.of("discordbot").prefilter.stats
+
+    if not stats:
+        return await context.reply("No messages seen yet.")
+
+    await context.reply("\n".join("{0}: {1}".format(stage, count)
+        for stage, count in stats.most_common()))
+
+@status_command.subcommand("scheduler",
+    description="Command queue depth and wait times.")
+@auth.requires_right(P_VIEW_STATUS)
+async def status_scheduler(context, message, text):
+    await context.reply(context.of("discordbot").scheduler.describe())
+
+@status_command.subcommand("outbound",
+    description="Messages sent through the outbound queue.")
+@auth.requires_right(P_VIEW_STATUS)
+async def status_outbound(context, message, text):
+    await context.reply(context.of("discordbot").outbound.describe())
+
+@status_command.subcommand("offload",
+    description="Work running in the process pool.")
+@auth.requires_right(P_VIEW_STATUS)
+async def status_offload(context, message, text):
+    await context.reply(context.of("discordbot").offloader.describe())
+
+@status_command.subcommand("rights",
+    description="Size and hit rate of the in-memory rights table.")
+@auth.requires_right(P_VIEW_STATUS)
+async def status_rights(context, message, text):
+    await context.reply(context.of("auth").describe())
+
+@status_command.subcommand("log",
+    description="Error log entries written, waiting, and dropped.")
+@auth.requires_right(P_VIEW_STATUS)
+async def status_log(context, message, text):
+    await context.reply(context.of("discordbot").log_db.describe())
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%d %H:%M UTC", time.gmtime(timestamp))
+
+@status_command.subcommand("errors",
+    description="The most frequent errors of the last few hours.",
+    synopsis="[hours]")
+@auth.requires_right(P_VIEW_STATUS)
+async def status_errors(context, message, text):
+    try:
+        hours = int(text) if text else 24
+    except ValueError:
+        return await context.reply("The window must be a number of hours.")
+
+    if hours < 1:
+        return await context.reply("The window must be at least an hour.")
+
+    groups = await context.of("discordbot").log_db.top_errors(hours)
+
+    if not groups:
+        return await context.reply("No errors in the last {0} hours.".format(hours))
+
+    await context.reply("\n".join("`{0}` {1}x {2}: {3} (last {4})".format(
+        fp, count, classname, description[:80], format_time(last_seen))
+        for fp, count, classname, description, last_seen in groups))
+
+@status_command.subcommand("error",
+    description="The stored trace and recent invocations of an error.",
+    synopsis="[fingerprint]")
+@auth.requires_right(P_VIEW_STATUS)
+async def status_error(context, message, text):
+    if not text:
+        return await context.reply("A fingerprint must be specified.")
+
+    details = await context.of("discordbot").log_db.error_details(text.strip())
+
+    if details is None:
+        return await context.reply("No error has that fingerprint.")
+
+    (fp, classname, trace, count, first_seen, last_seen), samples = details
+
+    lines = ["`{0}` {1}, seen {2}x from {3} to {4}".format(
+        fp, classname, count, format_time(first_seen), format_time(last_seen))]
+    lines.extend("{0} {1} {2}: {3}".format(format_time(when), server_id, user_id, invocation[:100])
+        for when, server_id, user_id, invocation in samples)
+    summary = "\n".join(lines)
+
+    # the end of the trace is the useful part; keep as much of it as fits
+    # in one message after the summary and the code block markers
+    room = outbound.MAX_MESSAGE_LENGTH - len(summary) - len("\n``````")
+    if room > 0:
+        summary += "\n```{0}```".format(trace[-room:])
+
+    await context.reply(summary)
+
+@status_command.subcommand("ratelimit",
+    description="Rate limit buckets and how often each scope throttled a command.")
+@auth.requires_right(P_VIEW_STATUS)
+async def status_ratelimit(context, message, text):
+    await context.reply(context.of("discordbot").rate_limiter.describe())
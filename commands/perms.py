@@ -60,7 +60,7 @@ async def grant(context, message, content, check_flag=1):
             return await context.reply("Undeclared right, {0}.".format(
                 flagname, content))
 
-        context.of("auth").write_permission(scope, subject, auth.declare_right(flagname), have)
+        await context.of("auth").write_permission(scope, subject, auth.declare_right(flagname), have)
 
     try:
         await context.client.add_reaction(message, "\u2705")
@@ -70,8 +70,7 @@ async def grant(context, message, content, check_flag=1):
 @loader.command("uid",
     description="Tells you what your user ID is.")
 async def whoami(context, message, content):
-    await context.client.send_message(message.channel,
-        "{0} {1}".format(message.author.mention, message.author.id))
+    await context.reply(message.author.id, mention=1)
 
 @loader.command("lsrole",
     description="List server roles.")
@@ -1,7 +1,9 @@
 import loader
 import config
-import sqlite3
+import asyncdb
+import storage
 import auth
+import coordination
 
 P_MANAGE_QUOTE = auth.declare_right("MANAGE_QUOTE")
 P_USE_QUOTE = auth.declare_right("USE_QUOTE")
@@ -9,84 +11,214 @@ P_USE_QUOTE = auth.declare_right("USE_QUOTE")
 class QuoteAlreadyExistsError(Exception):
     pass
 
+class QuoteShadowedError(Exception):
+    pass
+
+MIGRATIONS = [
+    """CREATE TABLE IF NOT EXISTS
+        quotes_v1 (
+            _command TEXT,
+            _originator TEXT,
+            _response TEXT
+        )
+    """,
+    storage.dedupe("quotes_v1", "_command") + """;
+    CREATE UNIQUE INDEX quotes_v1_command ON quotes_v1 (_command)
+    """,
+    # Quotes belong to a server now. The ones made before that go to
+    # GLOBAL_NAMESPACE, which every server can use.
+    """CREATE TABLE quotes_v2 (
+            _id INTEGER PRIMARY KEY,
+            _server TEXT,
+            _command TEXT,
+            _originator TEXT,
+            _response TEXT
+        );
+        CREATE UNIQUE INDEX quotes_v2_command ON quotes_v2 (_server, _command);
+        INSERT INTO quotes_v2 (_server, _command, _originator, _response)
+            SELECT '', _command, _originator, _response FROM quotes_v1;
+        DROP TABLE quotes_v1
+    """,
+]
+
+# Not a migration, since not every sqlite3 has FTS5. Without it, search
+# falls back to LIKE.
+SEARCH_INDEX = """BEGIN;
+    CREATE VIRTUAL TABLE IF NOT EXISTS quotes_fts_v2
+        USING fts5(_command, _response, content='quotes_v2', content_rowid='_id');
+    CREATE TRIGGER IF NOT EXISTS quotes_fts_v2_insert AFTER INSERT ON quotes_v2 BEGIN
+        INSERT INTO quotes_fts_v2 (rowid, _command, _response)
+            VALUES (new._id, new._command, new._response);
+    END;
+    CREATE TRIGGER IF NOT EXISTS quotes_fts_v2_delete AFTER DELETE ON quotes_v2 BEGIN
+        INSERT INTO quotes_fts_v2 (quotes_fts_v2, rowid, _command, _response)
+            VALUES ('delete', old._id, old._command, old._response);
+    END;
+    CREATE TRIGGER IF NOT EXISTS quotes_fts_v2_update AFTER UPDATE ON quotes_v2 BEGIN
+        INSERT INTO quotes_fts_v2 (quotes_fts_v2, rowid, _command, _response)
+            VALUES ('delete', old._id, old._command, old._response);
+        INSERT INTO quotes_fts_v2 (rowid, _command, _response)
+            VALUES (new._id, new._command, new._response);
+    END;
+    INSERT INTO quotes_fts_v2 (quotes_fts_v2) VALUES ('rebuild');
+    COMMIT;
+"""
+
+# Quotes of server ?, and global ones it doesn't have its own version of.
+# Takes (server, GLOBAL_NAMESPACE, server, server).
+VISIBLE = """q._server IN (?, ?) AND (q._server = ? OR NOT EXISTS (
+    SELECT 1 FROM quotes_v2 own WHERE own._server = ? AND own._command = q._command))"""
+
+# A name match counts for more than a match in the response.
+SEARCH_FTS = """SELECT q._command, q._response
+    FROM quotes_fts_v2 JOIN quotes_v2 q ON q._id = quotes_fts_v2.rowid
+    WHERE quotes_fts_v2 MATCH ? AND """ + VISIBLE + """
+    ORDER BY bm25(quotes_fts_v2, 10.0, 1.0)
+    LIMIT ? OFFSET ?"""
+
+SEARCH_LIKE = """SELECT q._command, q._response FROM quotes_v2 q
+    WHERE """ + VISIBLE + """
+    AND (q._command LIKE ? ESCAPE '\\' OR q._response LIKE ? ESCAPE '\\')
+    ORDER BY q._command LIKE ? ESCAPE '\\' DESC, q._command
+    LIMIT ? OFFSET ?"""
+
+LIST = """SELECT q._command FROM quotes_v2 q WHERE """ + VISIBLE + """
+    ORDER BY q._command
+    LIMIT ? OFFSET ?"""
+
+GLOBAL_NAMESPACE = ""
+
+def namespace_of(message):
+    return message.server.id if message.server else GLOBAL_NAMESPACE
+
+def match_expression(text):
+    """ Every word of text as an FTS5 prefix query, so user input can't
+        be read as query syntax. """
+
+    return " ".join('"{0}"*'.format(word.replace('"', '""')) for word in text.split())
+
+def like_pattern(text):
+    return "%{0}%".format(text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+
 @loader.context_class
 class QuoteDB(object):
     def __init__(self):
-        connection = sqlite3.connect("quotes.db")
-        connection.execute("""CREATE TABLE IF NOT EXISTS
-            quotes_v1 (
-                _command TEXT,
-                _originator TEXT,
-                _response TEXT
-            )
-        """)
-        connection.commit()
-
-        self.connection = connection
-        self.managed_command_names = set()
+        self.db = asyncdb.open_database("quotes.db", MIGRATIONS)
+
+        # (namespace, name) -> response. Every quote is held here,
+        # quotes.db is only written through to.
+        self.quotes = {}
+        self.searchable = False
 
     async def init_with_context(self, bot):
-        for name in self.quote_names():
-            self.guard_add_command(name)
+        self.quotes = {(server, name): response for server, name, response
+            in await self.db.query("SELECT _server, _command, _response FROM quotes_v2")}
+
+        if storage.has_fts5():
+            try:
+                if await self.db.query_one("SELECT 1 FROM sqlite_master WHERE name = 'quotes_fts_v2'") is None:
+                    await self.db.executescript(SEARCH_INDEX)
+                self.searchable = True
+            except Exception as e:
+                print("QuoteDB: can't build the search index, using LIKE:", repr(e))
+
+        loader.set_fallback("quote", self.has_quote, quote_command, provider=__name__)
+        coordination.subscribe(coordination.TOPIC_QUOTES, self.on_remote_write)
 
     async def deinit(self, bot):
-        for name in self.quote_names():
-            self.guard_delete_command(name)
+        coordination.unsubscribe(coordination.TOPIC_QUOTES, self.on_remote_write)
 
-    def guard_add_command(self, name):
-        if loader.is_usable_command(name):
-            print("guard_add_command: refusing to add {0} because it already exists".format(name))
-        else:
-            loader.register_command(name, execution=quote_command, hide=1)
-            self.managed_command_names.add(name)
+    def on_remote_write(self, payload):
+        key = (payload["server"], payload["name"])
 
-    def guard_delete_command(self, name):
-        if name in self.managed_command_names:
-            loader.delete_command(name)
-            self.managed_command_names.remove(name)
+        if payload["response"] is None:
+            self.quotes.pop(key, None)
+        else:
+            self.quotes[key] = payload["response"]
 
-    def quote_names(self):
-        k = self.connection.execute("SELECT _command FROM quotes_v1")
-        return [na for na, in k.fetchall()]
+    def has_quote(self, name, message):
+        return self.get_quote_for_name(namespace_of(message), name) is not None
 
-    def set_quote_for_name(self, name, response, originator):
+    async def set_quote_for_name(self, server, name, response, originator):
         name = name.lower()
+        key = (server, name)
 
-        if self.get_quote_for_name(name):
+        if key in self.quotes:
             raise QuoteAlreadyExistsError()
 
-        self.connection.execute("INSERT INTO quotes_v1 VALUES (?, ?, ?)", (name, originator, response))
-        self.connection.commit()
+        if loader.is_usable_command(name):
+            raise QuoteShadowedError()
+
+        # claim the name before awaiting, so a concurrent add can't take it too
+        self.quotes[key] = response
+        try:
+            await self.db.execute("INSERT INTO quotes_v2 (_server, _command, _originator, _response) VALUES (?, ?, ?, ?)",
+                (server, name, originator, response))
+        except Exception:
+            del self.quotes[key]
+            raise
+
+        coordination.publish(coordination.TOPIC_QUOTES, {"server": server, "name": name, "response": response})
 
-        self.guard_add_command(name)
+    async def delete_quote(self, server, name):
+        """ Only deletes from server's own namespace; global quotes can be
+            deleted from a DM. """
 
-    def delete_quote(self, name):
         name = name.lower()
 
-        self.connection.execute("DELETE FROM quotes_v1 WHERE _command = ?", (name,))
-        self.connection.commit()
+        self.quotes.pop((server, name), None)
+        await self.db.execute("DELETE FROM quotes_v2 WHERE _server = ? AND _command = ?", (server, name))
+        coordination.publish(coordination.TOPIC_QUOTES, {"server": server, "name": name, "response": None})
 
-        self.guard_delete_command(name)
+    def get_quote_for_name(self, server, name):
+        """ server's own quote, or the global one if it has none. Names
+            match exactly: they're stored lowercased, so a trigger typed
+            with capitals doesn't match, as before quotes moved to a
+            fallback. """
 
-    def get_quote_for_name(self, name):
-        name = name.lower()
+        response = self.quotes.get((server, name))
+
+        if response is None:
+            response = self.quotes.get((GLOBAL_NAMESPACE, name))
+
+        return response
 
-        k = self.connection.execute("SELECT _response FROM quotes_v1 WHERE _command = ?", (name,)).fetchone()
+    async def quote_names(self, server, page, page_size):
+        """ One page (counting from 0) of the names usable in server, in
+            order, and whether there are more. """
 
-        if k is None:
-            return None
+        rows = await self.db.query(LIST,
+            (server, GLOBAL_NAMESPACE, server, server, page_size + 1, page * page_size))
+        return [name for name, in rows[:page_size]], len(rows) > page_size
+
+    async def search(self, server, text, page, page_size):
+        """ One page of (name, response) matching text, best first, and
+            whether there are more. """
+
+        if self.searchable:
+            rows = await self.db.query(SEARCH_FTS,
+                (match_expression(text), server, GLOBAL_NAMESPACE, server, server,
+                 page_size + 1, page * page_size))
         else:
-            return k[0]
+            pattern = like_pattern(text)
+            rows = await self.db.query(SEARCH_LIKE,
+                (server, GLOBAL_NAMESPACE, server, server, pattern, pattern, pattern,
+                 page_size + 1, page * page_size))
+
+        return rows[:page_size], len(rows) > page_size
 
 @auth.requires_right(P_USE_QUOTE)
 async def quote_command(context, message, content):
-    response = context.of(loader.localname(__name__)).get_quote_for_name(context.arg0)
+    response = context.of(loader.localname(__name__)).get_quote_for_name(namespace_of(message), context.arg0)
 
     if response:
         await context.reply(response)
     else:
         print("quote_command: bug: {0} bound but not defined".format(context.arg0))
 
+def page_size():
+    return config.get("quote.page_size", 20)
+
 manage_quote = loader.register_command("quote",
     description="Manage quotes.")
 
@@ -99,19 +231,64 @@ async def add_quote(context, message, content):
         return await context.reply("usage: add_quote [command] [response...]", mention=1)
 
     try:
-        context.set_quote_for_name(args[0], args[1], message.author.id)
+        await context.set_quote_for_name(namespace_of(message), args[0], args[1], message.author.id)
         await context.reply("Added '{0}'.".format(args[0]), mention=1)
     except QuoteAlreadyExistsError:
         return await context.reply("That quote already exists. Delete it first.", mention=1)
+    except QuoteShadowedError:
+        return await context.reply("There's already a command with that name, nya.", mention=1)
 
 @manage_quote.subcommand("delete")
 @auth.requires_right(P_MANAGE_QUOTE)
 async def del_quote(context, message, content):
-    context.delete_quote(content)
+    await context.delete_quote(namespace_of(message), content)
     await context.reply("Quote was deleted (if it existed).", mention=1)
 
-@manage_quote.subcommand("list")
+@manage_quote.subcommand("list",
+    synopsis="[page]")
 @auth.requires_right(P_MANAGE_QUOTE)
 async def list_quote(context, message, content):
-    context.delete_quote(content)
-    await context.reply("Available: `{0}`".format(" ".join(context.quote_names())), mention=1)
+    try:
+        page = int(content) if content else 1
+    except ValueError:
+        return await context.reply("usage: list [page]", mention=1)
+
+    if page < 1:
+        return await context.reply("Pages start at 1.", mention=1)
+
+    names, more = await context.quote_names(namespace_of(message), page - 1, page_size())
+
+    if not names:
+        return await context.reply("No quotes on page {0}.".format(page), mention=1)
+
+    reply = "Available (page {0}): `{1}`".format(page, " ".join(names))
+    if more:
+        reply += "\nMore with `{0} {1}`.".format(context.arg0, page + 1)
+
+    await context.reply(reply, mention=1)
+
+@manage_quote.subcommand("search",
+    synopsis="[search terms...] [#page]")
+@auth.requires_right(P_USE_QUOTE)
+async def search_quote(context, message, content):
+    words = content.split()
+    page = 1
+
+    if words and words[-1].startswith("#") and words[-1][1:].isdigit():
+        page = max(1, int(words.pop()[1:]))
+
+    if not words:
+        return await context.reply("usage: search [search terms...] [#page]", mention=1)
+
+    text = " ".join(words)
+    results, more = await context.search(namespace_of(message), text, page - 1, page_size())
+
+    if not results:
+        return await context.reply("No quotes match that.", mention=1)
+
+    lines = ["`{0}`: {1}".format(name, response if len(response) <= 80 else response[:79] + "\u2026")
+        for name, response in results]
+    if more:
+        lines.append("More with `{0} {1} #{2}`.".format(context.arg0, text, page + 1))
+
+    await context.reply("\n".join(lines), mention=1)
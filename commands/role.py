@@ -1,7 +1,9 @@
 import loader
 import discord
-import sqlite3
+import asyncdb
+import storage
 import auth
+import coordination
 
 P_SELFROLE_ADMIN = auth.declare_right("SELFROLE_ADMIN")
 P_SELFROLE_USE = auth.declare_right("SELFROLE_USE")
@@ -9,40 +11,138 @@ P_SELFROLE_USE = auth.declare_right("SELFROLE_USE")
 class RoleNotFound(Exception):
     pass
 
+class RolesExclusive(Exception):
+    pass
+
+MIGRATIONS = [
+    """CREATE TABLE IF NOT EXISTS
+        selfroles_v1 (
+            server TEXT,
+            name TEXT,
+            role_id TEXT,
+            mutual_exclusion_group INT
+        )
+    """,
+    storage.dedupe("selfroles_v1", "server, role_id") + """;
+    CREATE UNIQUE INDEX selfroles_v1_role ON selfroles_v1 (server, role_id);
+    CREATE INDEX selfroles_v1_name ON selfroles_v1 (server, name)
+    """,
+]
+
 @loader.context_class
 class SelfRoleDB(object):
     def __init__(self):
-        connection = sqlite3.connect("selfrole.db")
-        connection.execute("""CREATE TABLE IF NOT EXISTS
-            selfroles_v1 (
-                server TEXT,
-                name TEXT,
-                role_id TEXT,
-                mutual_exclusion_group INT
-            )
-        """)
-        connection.commit()
-
-        self.connection = connection
-
-    def add_sar(self, server, role_id, name):
-        self.connection.execute("INSERT INTO selfroles_v1 VALUES (?, ?, ?, ?)",
-            (server, name, role_id, None))
-        self.connection.commit()
-
-    def remove_sar(self, server, role_id):
-        self.connection.execute("DELETE FROM selfroles_v1 WHERE server=? AND role_id=?",
+        self.db = asyncdb.open_database("selfrole.db", MIGRATIONS)
+
+    async def add_sar(self, server, role_id, name):
+        # keeps the exclusion group if the role was already assignable
+        await self.db.execute("""INSERT OR REPLACE INTO selfroles_v1 VALUES (?, ?, ?,
+            (SELECT mutual_exclusion_group FROM selfroles_v1 WHERE server=? AND role_id=?))""",
+            (server, name, role_id, server, role_id))
+        coordination.publish(coordination.TOPIC_SELFROLES, {"server": server})
+
+    async def remove_sar(self, server, role_id):
+        await self.db.execute("DELETE FROM selfroles_v1 WHERE server=? AND role_id=?",
             (server, role_id))
-        self.connection.commit()
+        coordination.publish(coordination.TOPIC_SELFROLES, {"server": server})
+
+    async def find_roles(self, server, names):
+        """ (name, role_id, mutual_exclusion_group) of each role in names,
+            and of every role sharing an exclusion group with one of them,
+            in one query. Raises RoleNotFound for the first missing name. """
+
+        names = list(dict.fromkeys(names))
+        marks = ", ".join("?" * len(names))
+
+        rows = await self.db.query("""SELECT name, role_id, mutual_exclusion_group FROM selfroles_v1
+            WHERE server=? AND (name IN ({0}) OR mutual_exclusion_group IN (
+                SELECT mutual_exclusion_group FROM selfroles_v1 WHERE server=? AND name IN ({0})))""".format(marks),
+            [server] + names + [server] + names)
+
+        found = {row[0] for row in rows}
+        for name in names:
+            if name not in found:
+                raise RoleNotFound(name)
+
+        return rows
+
+    async def set_exclusion_group(self, server, role_id, group):
+        """ group is an int, or None to take the role out of its group.
+            Returns whether the role is self-assignable. """
+
+        changed = await self.db.execute("UPDATE selfroles_v1 SET mutual_exclusion_group=? WHERE server=? AND role_id=?",
+            (group, server, role_id))
+        coordination.publish(coordination.TOPIC_SELFROLES, {"server": server})
+        return changed > 0
+
+def compute_roles(member, rows, names, role_map, adding):
+    """ The member's roles after adding (or removing) the roles called
+        names. Adding a role from an exclusion group takes away the
+        member's other roles from that group. rows are from find_roles,
+        role_map is role id -> Role for the server. """
+
+    requested = [row for row in rows if row[0] in names]
+
+    for row in requested:
+        if row[1] not in role_map:
+            # the role was deleted from the server but not from the list
+            raise RoleNotFound(row[0])
+
+    remove = set()
+    add = []
+
+    if adding:
+        groups = {}
+        for name, role_id, group in requested:
+            if group is not None:
+                if group in groups:
+                    raise RolesExclusive(groups[group], name)
+                groups[group] = name
 
-    def find_role(self, server, name):
-        cur = self.connection.execute("SELECT role_id FROM selfroles_v1 WHERE server=? AND name=?",
-            (server, name)).fetchone()
+            add.append(role_map[role_id])
 
-        if cur is None:
-            raise RoleNotFound(name)
+        remove.update(role_id for _, role_id, group in rows if group in groups)
+        remove.difference_update(role.id for role in add)
+    else:
+        remove.update(role_id for _, role_id, _ in requested)
+
+    kept = [role for role in member.roles if role.id not in remove]
+    kept_ids = {role.id for role in kept}
+    return kept + [role for role in add if role.id not in kept_ids]
+
+async def edit_self_roles(context, message, text, adding):
+    """ Shared by addrole and delrole: one lookup, one member edit. """
+
+    if not message.server:
+        return await context.reply("This command cannot be executed in a DM context.")
 
-        return cur[0]
+    names = [name.strip() for name in text.split(",") if name.strip()]
+
+    if not names:
+        return await context.reply("Which roles, nya?", mention=1)
+
+    try:
+        rows = await context.find_roles(message.server.id, names)
+        role_map = {role.id: role for role in message.server.roles}
+        new_roles = compute_roles(message.member, rows, names, role_map, adding)
+    except RoleNotFound as offender:
+        return await context.reply("Can't find role '{0}', or it is not assignable on this server.".format(str(offender)),
+            mention=1)
+    except RolesExclusive as e:
+        return await context.reply("You can only have one of '{0}' and '{1}'.".format(*e.args), mention=1)
+
+    if [role.id for role in new_roles] != [role.id for role in message.member.roles]:
+        try:
+            await context.client.replace_roles(message.member, *new_roles)
+        except discord.errors.Forbidden:
+            return await context.reply("Sorry, I can't {0} roles on this server. "
+                "If I should be able to and you are seeing this message, please let a server admin know.".format(
+                "assign" if adding else "remove"))
+
+    if adding:
+        await context.reply("OK, I've given you the requested roles.")
+    else:
+        await context.reply("OK, I've removed the requested roles from you.")
 
 ROLE_COMMAND = loader.register_command("role")
 
@@ -59,7 +159,7 @@ async def make_not_self_assignable(context, message, text):
     else:
         the_role = discord.utils.get(message.server.roles, name=text.strip())
 
-    context.remove_sar(message.server.id, the_role.id)
+    await context.remove_sar(message.server.id, the_role.id)
     await context.reply("OK.")
 
 @ROLE_COMMAND.subcommand("make_self_assignable", "msa",
@@ -75,7 +175,40 @@ async def make_self_assignable(context, message, text):
     else:
         the_role = discord.utils.get(message.server.roles, name=text.strip())
 
-    context.add_sar(message.server.id, the_role.id, the_role.name)
+    await context.add_sar(message.server.id, the_role.id, the_role.name)
+    await context.reply("OK.")
+
+@ROLE_COMMAND.subcommand("exclusion_group", "group",
+    description="Put a self-assignable role in an exclusion group. Members can only have one role from each group; "
+        "adding one takes away the others.",
+    synopsis="[group number | none] [role name]",
+    examples=["1 Red", "none Blue"])
+@auth.requires_right(P_SELFROLE_ADMIN)
+async def set_exclusion_group(context, message, text):
+    if not message.server:
+        return await context.reply("This command cannot be executed in a DM context.")
+
+    args = text.split(maxsplit=1)
+
+    if len(args) != 2:
+        return await context.reply("usage: exclusion_group [group number | none] [role name]", mention=1)
+
+    if args[0].lower() == "none":
+        group = None
+    else:
+        try:
+            group = int(args[0])
+        except ValueError:
+            return await context.reply("The group must be a number, or 'none'.", mention=1)
+
+    if args[1].startswith("'"):
+        the_role = discord.utils.get(message.server.roles, id=args[1].strip()[1:])
+    else:
+        the_role = discord.utils.get(message.server.roles, name=args[1].strip())
+
+    if the_role is None or not await context.set_exclusion_group(message.server.id, the_role.id, group):
+        return await context.reply("That role isn't self-assignable.", mention=1)
+
     await context.reply("OK.")
 
 @ROLE_COMMAND.subcommand("add",
@@ -84,27 +217,7 @@ async def make_self_assignable(context, message, text):
     examples=["Red, James Chungler", "Blue"])
 @auth.requires_right(P_SELFROLE_USE)
 async def addrole(context, message, text):
-    rolenames = text.split(",")
-
-    if not message.server:
-        await context.reply("This command cannot be executed in a DM context.")
-
-    add_roles = []
-    try:
-        for a_role in rolenames:
-            id = context.find_role(message.server.id, a_role.strip())
-            add_roles.append(discord.utils.get(message.server.roles, id=id))
-    except RoleNotFound as offender:
-        return await context.reply("Can't find role '{0}', or it is not assignable on this server.".format(str(offender)),
-            mention=1)
-
-    try:
-        await context.client.add_roles(message.member, *add_roles)
-    except discord.errors.Forbidden:
-        await context.reply("Sorry, I can't assign roles on this server. "
-            "If I should be able to and you are seeing this message, please let a server admin know.")
-    else:
-        await context.reply("OK, I've given you the requested roles.")
+    await edit_self_roles(context, message, text, adding=1)
 
 @ROLE_COMMAND.subcommand("del", "delete",
     description="Remove one or more roles from yourself (they must be from the self-assignable list).",
@@ -112,25 +225,4 @@ async def addrole(context, message, text):
     examples=["Red, James Chungler", "Blue"])
 @auth.requires_right(P_SELFROLE_USE)
 async def delrole(context, message, text):
-    rolenames = text.split(",")
-
-    if not message.server:
-        await context.reply("This command cannot be executed in a DM context.")
-
-    edit_roles = []
-    try:
-        for a_role in rolenames:
-            id = context.find_role(message.server.id, a_role.strip())
-            edit_roles.append(discord.utils.get(message.server.roles, id=id))
-    except RoleNotFound as offender:
-        return await context.reply("Can't find role '{0}', or it is not assignable on this server.".format(str(offender)),
-            mention=1)
-
-    try:
-        await context.client.remove_roles(message.member, *edit_roles)
-    except discord.errors.Forbidden:
-        await context.reply("Sorry, I can't remove roles on this server. "
-            "If I should be able to and you are seeing this message, please let a server admin know.")
-    else:
-        await context.reply("OK, I've removed the requested roles from you.")
-
+    await edit_self_roles(context, message, text, adding=0)
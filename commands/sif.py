@@ -4,6 +4,7 @@ import random
 
 import loader
 import auth
+import reply_cache
 
 P_SIF_PUBLIC = auth.declare_right("SIF_PUBLIC")
 
@@ -12,8 +13,10 @@ sif = loader.register_command("sif",
 
 @sif.subcommand("cutoffs",
     description="Retrieve current event cutoffs.",
-    synopsis="[en | jp]")
+    synopsis="[en | jp]",
+    deadline=30)
 @auth.requires_right(P_SIF_PUBLIC)
+@reply_cache.cached_reply(60)
 async def sif_cutoffs(context, message, text):
     events = await lldata.llsif_fetch_eventinfo()
 
@@ -1,50 +1,210 @@
-import sqlite3
 import os
 import json
+import storage
+import traceback
+import coordination
+from types import MappingProxyType
+
+# Scopes for per-server and per-channel overrides. Lookups go
+# channel -> server -> global.
+SCOPE_SERVER  = "server"
+SCOPE_CHANNEL = "channel"
 
 path = os.getenv("BOT_CONFIG_PATH", "configuration.db")
 print("config: connecting")
-_connection = sqlite3.connect(path)
-_connection.execute("""CREATE TABLE IF NOT EXISTS
-    configuration (
-        _key TEXT,
-        _value TEXT
-    )
-""")
-_connection.commit()
-_cache = {}
+MIGRATIONS = [
+    """CREATE TABLE IF NOT EXISTS
+        configuration (
+            _key TEXT,
+            _value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS
+        scoped_configuration_v1 (
+            _scope TEXT,
+            _subject TEXT,
+            _key TEXT,
+            _value TEXT
+        )
+    """,
+    storage.dedupe("configuration", "_key") + ";" +
+    storage.dedupe("scoped_configuration_v1", "_scope, _subject, _key") + """;
+    CREATE UNIQUE INDEX configuration_key ON configuration (_key);
+    CREATE UNIQUE INDEX scoped_configuration_v1_key ON scoped_configuration_v1 (_scope, _subject, _key)
+    """,
+]
 
-def get_json(key):
-    return (_connection.execute("SELECT _value FROM configuration WHERE _key = ?", (key,)).fetchone() or (None,)) [0]
+_connection = storage.connect(path)
+storage.migrate(_connection, MIGRATIONS, path)
+_MISSING = object()
 
-def get(key, default=None):
-    if key in _cache:
-        return _cache[key]
-    
-    jsval = get_json(key)
+def freeze(value):
+    """ value (parsed JSON) with lists turned into tuples and objects into
+        read-only mappings, so nothing read from a Snapshot can be changed
+        in place. """
+
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+
+    return value
+
+class Snapshot(object):
+    """ Everything in configuration.db, parsed. Never modified once built;
+        writes build a new one and swap it in, so a reader always sees a
+        consistent set of values. Keys that aren't in the snapshot don't
+        exist, so misses don't need the database either. """
+    __slots__ = ("values", "layers")
+
+    def __init__(self, values, layers):
+        # key -> value
+        self.values = MappingProxyType(values)
+        # (scope, subject) -> {key: value}
+        self.layers = MappingProxyType({k: MappingProxyType(v) for k, v in layers.items()})
+
+    def replace(self, key, value):
+        values = dict(self.values)
+        if value is _MISSING:
+            values.pop(key, None)
+        else:
+            values[key] = freeze(value)
+
+        return Snapshot(values, self.layers)
+
+    def replace_scoped(self, scope, subject, key, value):
+        layers = {k: dict(v) for k, v in self.layers.items()}
+        layer = layers.setdefault((scope, subject), {})
+        if value is _MISSING:
+            layer.pop(key, None)
+        else:
+            layer[key] = freeze(value)
+
+        return Snapshot(self.values, layers)
+
+def load_snapshot():
+    values = {key: freeze(json.loads(jsval)) for key, jsval in
+              _connection.execute("SELECT _key, _value FROM configuration")}
+    layers = {}
 
-    if jsval is None:
-        return default
+    for scope, subject, key, jsval in _connection.execute(
+            "SELECT _scope, _subject, _key, _value FROM scoped_configuration_v1"):
+        layers.setdefault((scope, subject), {})[key] = freeze(json.loads(jsval))
 
-    pyval = json.loads(jsval)
-    _cache[key] = pyval
-    return pyval
+    return Snapshot(values, layers)
+
+_snapshot = load_snapshot()
+# [(key prefix, callback)], see subscribe
+_subscribers = []
+
+def snapshot():
+    return _snapshot
+
+def subscribe(prefix, callback):
+    """ Call callback(key) after a key starting with prefix (e.g.
+        "deresute.") is written or deleted, at any scope, by us or by
+        another shard. """
+    _subscribers.append((prefix, callback))
+
+def unsubscribe(prefix, callback):
+    if (prefix, callback) in _subscribers:
+        _subscribers.remove((prefix, callback))
+
+def swap(new_snapshot, key):
+    global _snapshot
+    _snapshot = new_snapshot
+
+    for prefix, callback in list(_subscribers):
+        if key.startswith(prefix):
+            try:
+                callback(key)
+            except Exception:
+                print("config: subscriber for", prefix, "failed")
+                traceback.print_exc()
+
+def get(key, default=None):
+    value = _snapshot.values.get(key, _MISSING)
+    return default if value is _MISSING else value
+
+def get_json(key):
+    value = _snapshot.values.get(key, _MISSING)
+    return None if value is _MISSING else json.dumps(value, default=dict)
 
 def write(key, value):
-    write_direct(key, json.dumps(value))
+    write_direct(key, json.dumps(value, default=dict))
 
 def write_direct(key, value):
-    k = _connection.execute("UPDATE configuration SET _value = ? WHERE _key = ?", (value, key))
-    if k.rowcount == 0:
-        _connection.execute("INSERT INTO configuration VALUES (?, ?)", (key, value))
+    _connection.execute("INSERT OR REPLACE INTO configuration VALUES (?, ?)", (key, value))
     _connection.commit()
-    
-    try:
-        del _cache[key]
-    except KeyError:
-        pass
+
+    swap(_snapshot.replace(key, json.loads(value)), key)
+    coordination.publish(coordination.TOPIC_CONFIG, {"key": key})
+
+def get_override(key, server_id=None, channel_id=None, default=None):
+    """ Look up key in the channel, then server layer only. Returns default
+        if neither overrides it. Never touches the database. """
+
+    layers = _snapshot.layers
+
+    if channel_id is not None:
+        layer = layers.get((SCOPE_CHANNEL, channel_id))
+        if layer and key in layer:
+            return layer[key]
+
+    if server_id is not None:
+        layer = layers.get((SCOPE_SERVER, server_id))
+        if layer and key in layer:
+            return layer[key]
+
+    return default
+
+def get_scoped(key, server_id=None, channel_id=None, default=None):
+    """ Look up key in the channel, server, then global layer. """
+
+    value = get_override(key, server_id, channel_id, _MISSING)
+
+    if value is _MISSING:
+        return get(key, default)
+
+    return value
+
+def write_scoped(scope, subject, key, value):
+    write_scoped_direct(scope, subject, key, json.dumps(value, default=dict))
+
+def write_scoped_direct(scope, subject, key, value):
+    _connection.execute("INSERT OR REPLACE INTO scoped_configuration_v1 VALUES (?, ?, ?, ?)", (scope, subject, key, value))
+    _connection.commit()
+
+    swap(_snapshot.replace_scoped(scope, subject, key, json.loads(value)), key)
+    coordination.publish(coordination.TOPIC_CONFIG, {"scope": scope, "subject": subject, "key": key})
+
+def delete_scoped(scope, subject, key):
+    _connection.execute("DELETE FROM scoped_configuration_v1 WHERE _scope = ? AND _subject = ? AND _key = ?",
+        (scope, subject, key))
+    _connection.commit()
+
+    swap(_snapshot.replace_scoped(scope, subject, key, _MISSING), key)
+    coordination.publish(coordination.TOPIC_CONFIG, {"scope": scope, "subject": subject, "key": key})
 
 def flush():
-    global _cache
-    _cache = {}
+    """ Re-read everything, e.g. after editing configuration.db by hand. """
+
+    global _snapshot
+    _snapshot = load_snapshot()
+
+def on_remote_write(payload):
+    """ Another shard changed a key. Re-read it and tell our subscribers. """
+
+    key = payload["key"]
+
+    if "scope" not in payload:
+        row = _connection.execute("SELECT _value FROM configuration WHERE _key = ?", (key,)).fetchone()
+        swap(_snapshot.replace(key, json.loads(row[0]) if row else _MISSING), key)
+        return
+
+    scope, subject = payload["scope"], payload["subject"]
+    row = _connection.execute("SELECT _value FROM scoped_configuration_v1 WHERE _scope = ? AND _subject = ? AND _key = ?",
+        (scope, subject, key)).fetchone()
+
+    swap(_snapshot.replace_scoped(scope, subject, key, json.loads(row[0]) if row else _MISSING), key)
 
+coordination.subscribe(coordination.TOPIC_CONFIG, on_remote_write)
@@ -0,0 +1,92 @@
+import asyncio
+import json
+import os
+import traceback
+
+# Lets the workers of a sharded bot (see launcher.py) tell each other
+# about writes to shared state, so caches can be invalidated without
+# polling the databases. The launcher relays every published message to
+# all other workers. When the bot runs on its own, publish does nothing.
+
+SOCKET_ENV = "BOT_COORDINATION_SOCKET"
+
+TOPIC_CONFIG    = "config"
+TOPIC_RIGHTS    = "rights"
+TOPIC_QUOTES    = "quotes"
+TOPIC_SELFROLES = "selfroles"
+TOPIC_GATEWAY   = "gateway"
+
+_subscribers = {}
+_writer = None
+
+def socket_path():
+    return os.getenv(SOCKET_ENV)
+
+def encode(topic, payload):
+    return (json.dumps({"topic": topic, "payload": payload}) + "\n").encode("utf8")
+
+def decode(line):
+    msg = json.loads(line.decode("utf8"))
+    return msg["topic"], msg["payload"]
+
+def subscribe(topic, callback):
+    """ Call callback(payload) whenever another worker publishes to topic.
+        Callbacks run on the event loop and must not block. """
+    _subscribers.setdefault(topic, []).append(callback)
+
+def unsubscribe(topic, callback):
+    callbacks = _subscribers.get(topic)
+
+    if callbacks and callback in callbacks:
+        callbacks.remove(callback)
+
+def publish(topic, payload=None):
+    """ Tell the other workers about a change. payload must be JSON
+        serializable. Our own subscribers aren't called. """
+
+    if _writer is None:
+        return
+
+    _writer.write(encode(topic, payload))
+
+def deliver(topic, payload):
+    for callback in list(_subscribers.get(topic, ())):
+        try:
+            callback(payload)
+        except Exception:
+            print("coordination: subscriber for", topic, "failed")
+            traceback.print_exc()
+
+async def connect(loop):
+    """ Connect to the launcher's relay, if we were started by one. """
+
+    global _writer
+
+    path = socket_path()
+    if path is None:
+        return
+
+    reader, _writer = await asyncio.open_unix_connection(path)
+    print("coordination: connected to", path)
+    loop.create_task(listen(reader))
+
+async def listen(reader):
+    global _writer
+
+    try:
+        while 1:
+            line = await reader.readline()
+            if not line:
+                break
+
+            try:
+                topic, payload = decode(line)
+            except (ValueError, KeyError):
+                print("coordination: dropping malformed message", line[:80])
+                continue
+
+            deliver(topic, payload)
+    finally:
+        # the launcher is gone. keep running, but publish is a no-op now
+        print("coordination: lost connection to the launcher")
+        _writer = None
@@ -0,0 +1,83 @@
+import asyncio
+import time
+import weakref
+import config
+import async_timeout
+
+# The deadline is tracked per task, so anything awaited by a command's
+# executor (cfetch, ctlstrings, ...) sees its budget without it having
+# to be passed down explicitly.
+_current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+_deadlines = weakref.WeakKeyDictionary()
+
+class DeadlineExceeded(Exception):
+    """ Raised when a budget runs out, by budget itself or by remaining().
+        Unlike a plain asyncio.TimeoutError, it can't come from anywhere
+        else. """
+    pass
+
+def grace():
+    return config.get("bot.deadline_grace", 2)
+
+def remaining(cap=None):
+    """ Seconds left in the current task's budget, limited to cap, less
+        bot.deadline_grace seconds kept back so the caller still has time
+        to reply after its operation times out. Returns cap if there's no
+        budget. Raises DeadlineExceeded if the budget is already spent. """
+
+    task = _current_task()
+    until = _deadlines.get(task) if task is not None else None
+
+    if until is None:
+        return cap
+
+    left = until - time.monotonic() - grace()
+    if left <= 0:
+        raise DeadlineExceeded()
+
+    return left if cap is None else min(cap, left)
+
+class budget(object):
+    """ Give the current task at most `seconds` to finish the with block.
+        Nested budgets can only shorten the deadline. When it runs out the
+        block is cancelled and DeadlineExceeded is raised. So is a
+        TimeoutError that leaves the block in the grace period, since it
+        came from something that was given all of the remaining() time. """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.task = None
+        self.previous = None
+        self.until = None
+        self.grace = None
+        self.timeout = None
+
+    def __enter__(self):
+        self.task = _current_task()
+        self.previous = _deadlines.get(self.task)
+
+        until = time.monotonic() + self.seconds
+        if self.previous is not None:
+            until = min(until, self.previous)
+
+        _deadlines[self.task] = self.until = until
+        self.grace = grace()
+        self.timeout = async_timeout.timeout(max(0, until - time.monotonic()))
+        return self.timeout.__enter__()
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            try:
+                self.timeout.__exit__(exc_type, exc, tb)
+            except asyncio.TimeoutError as e:
+                # async_timeout turns its own cancellation into a TimeoutError
+                raise DeadlineExceeded() from e
+
+            if exc_type is not None and issubclass(exc_type, asyncio.TimeoutError) and \
+                    time.monotonic() >= self.until - self.grace:
+                raise DeadlineExceeded() from exc
+        finally:
+            if self.previous is None:
+                del _deadlines[self.task]
+            else:
+                _deadlines[self.task] = self.previous
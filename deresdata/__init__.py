@@ -1,4 +1,4 @@
 from .query import parse_query, InvalidQueryError
-from .ark import build_ark, exec_query, needs_update, build_keywords
+from .ark import build_ark, exec_query, search, search_awake, needs_update, build_keywords
 from .event import EventReader, NoCurrentEventError, CurrentEventNotRankingError, NoDataCurrentlyAvailableError
 from .httputils import cfetch, ctlstrings
\ No newline at end of file
@@ -1,10 +1,12 @@
-import sqlite3
 import json
 import requests
 import unicodedata
 from itertools import starmap
 from collections import namedtuple, defaultdict
 from . import httputils
+import offload
+import asyncdb
+import storage
 try:
     from . import query
     from .query import InvalidQueryError
@@ -12,7 +14,7 @@ except SystemError:
     import query
     from query import InvalidQueryError
 
-SCHEMA = """
+MIGRATIONS = ["""
 CREATE TABLE IF NOT EXISTS meta_v2 (
     truth_version  TEXT,
     keywords_time  INT
@@ -38,12 +40,20 @@ CREATE TABLE IF NOT EXISTS keywords_v1 (
     word        TEXT,
     position    INT
 );
-"""
-CLEAR_DB = """
-DELETE FROM meta_v2;
-DELETE FROM names_v1;
-DELETE FROM cards_v1;
-"""
+""", """
+CREATE INDEX keywords_v1_word ON keywords_v1 (word, refs_id);
+CREATE INDEX cards_v1_chara ON cards_v1 (chara_id)
+"""]
+INDEX_PATH = "drst_search_index.db"
+
+CLEAR_DB = [
+    ("execute", "DELETE FROM meta_v2", ()),
+    ("execute", "DELETE FROM names_v1", ()),
+    ("execute", "DELETE FROM cards_v1", ()),
+]
+_index_db = None
+_search_connection = None
+
 filterable_card_data_t = namedtuple("filterable_card_data_t",
     ("root_id", "awakened_id", "rarity", "attribute", "chara_id", "sort_key", "av_flag", "kw_relevance"))
 
@@ -61,20 +71,13 @@ def gacha_is_limited(e):
     return e & 0x1
 
 async def build_ark():
-    conn = sqlite3.connect("drst_search_index.db")
-    prep_db(conn)
-
-    conn.executescript(CLEAR_DB)
-    conn.commit()
+    db = index_db()
 
+    # fetch everything first and swap the index in one transaction, so
+    # searches never see it half built
     print("Building name list...")
     ns = await httputils.cfetch("https://starlight.kirara.ca/api/v2/char_t/all?keys=chara_id,conventional")
-    conn.executemany("INSERT INTO names_v1 VALUES (:chara_id, lower(:conventional))",
-        ns["result"])
-
     cs = await httputils.cfetch("https://starlight.kirara.ca/api/v2/card_t/all?keys=id,evolution_id,rarity,attribute,chara_id")
-    conn.executemany("INSERT INTO cards_v1 VALUES (:id, :evolution_id, :rarity, :attribute, :chara_id, 0, 0)",
-        cs["result"])
 
     flg_bag = defaultdict(lambda: 0)
     rls_bag = {}
@@ -99,14 +102,17 @@ async def build_ark():
         for cid in cl.get("limited", []):
             flg_bag[cid] |= query.NL_FILTER_LIMITED
 
-    conn.executemany("UPDATE cards_v1 SET sort_key = ?, av_flag = ? WHERE root_id = ?",
-        map(lambda x: (rls_bag[x], flg_bag[x], x), [x["id"] for x in cs["result"]]))
-
     meta = await httputils.cfetch("https://starlight.kirara.ca/api/v1/info")
-    conn.execute("INSERT INTO meta_v2 VALUES (?, ?)", (meta["truth_version"], 0))
 
-    conn.commit()
-    conn.close()
+    await db.transaction(CLEAR_DB + [
+        ("executemany", "INSERT INTO names_v1 VALUES (:chara_id, lower(:conventional))",
+            ns["result"]),
+        ("executemany", "INSERT INTO cards_v1 VALUES (:id, :evolution_id, :rarity, :attribute, :chara_id, 0, 0)",
+            cs["result"]),
+        ("executemany", "UPDATE cards_v1 SET sort_key = ?, av_flag = ? WHERE root_id = ?",
+            map(lambda x: (rls_bag[x], flg_bag[x], x), [x["id"] for x in cs["result"]])),
+        ("execute", "INSERT INTO meta_v2 VALUES (?, ?)", (meta["truth_version"], 0)),
+    ])
 
 def title_split(t):
     words = unicodedata.normalize("NFD", t)
@@ -128,10 +134,20 @@ def title_split(t):
         if buf:
             yield "".join(buf).lower()
 
+def keyword_rows(titles):
+    """ (card id, word, position) for each word of 3+ characters in the
+        {card id: translated title} dict. Runs in the offload pool. """
+
+    rows = []
+    for id, title in titles.items():
+        for pos, word in enumerate(title_split(title)):
+            if len(word) >= 3:
+                rows.append((id, word, pos))
+
+    return rows
+
 async def build_keywords():
-    conn = sqlite3.connect("drst_search_index.db")
-    prep_db(conn)
-    conn.execute("DELETE FROM keywords_v1")
+    db = index_db()
 
     cs = await httputils.cfetch("https://starlight.kirara.ca/api/v2/card_t/all?keys=id,title")
     id_map = {k["id"]: k["title"]
@@ -139,37 +155,42 @@ async def build_keywords():
     tl_list = list(set(id_map.values()))
     tl_dictionary = await httputils.ctlstrings(tl_list)
 
-    inserts = 0
-    curs = conn.cursor()
-    for id in id_map:
-        tl_result = tl_dictionary.get(id_map[id])
-        if tl_result is None:
-            continue
-
-        for pos, word in enumerate(title_split(tl_result)):
-            if len(word) >= 3:
-                curs.execute("INSERT INTO keywords_v1 VALUES (?, ?, ?)", (id, word, pos))
-                inserts += 1
-
-    conn.commit()
-    conn.close()
+    titles = {id: tl_dictionary[title] for id, title in id_map.items() if title in tl_dictionary}
+    rows = await offload.run(keyword_rows, titles)
+    await db.transaction([
+        ("execute", "DELETE FROM keywords_v1", ()),
+        ("executemany", "INSERT INTO keywords_v1 VALUES (?, ?, ?)", rows),
+    ])
+    inserts = len(rows)
 
     return (inserts, len(id_map))
 
-def needs_update(current_truth_version):
-    conn = sqlite3.connect("drst_search_index.db")
-    prep_db(conn)
-
-    result = conn.execute("SELECT truth_version FROM meta_v2").fetchone()
-    conn.close()
+async def needs_update(current_truth_version):
+    result = await index_db().query_one("SELECT truth_version FROM meta_v2")
     if result is None or result[0] != current_truth_version:
         return 1
 
     return 0
 
-def prep_db(c):
-    c.executescript(SCHEMA)
-    c.commit()
+def index_db():
+    global _index_db
+
+    if _index_db is None:
+        _index_db = asyncdb.open_database(INDEX_PATH, MIGRATIONS)
+
+    return _index_db
+
+def search_connection():
+    """ exec_query runs in offload worker processes, which keep one
+        connection each instead of opening one per search. The schema
+        is migrated by index_db in the bot's process. """
+
+    global _search_connection
+
+    if _search_connection is None:
+        _search_connection = storage.connect(INDEX_PATH)
+
+    return _search_connection
 
 def chara_id_from_name(conn, name):
     if len(name) == 1:
@@ -197,12 +218,21 @@ def exec_query(query_):
     else:
         return exec_query_search(query_)
 
+def search(text):
+    """ parse_query + exec_query for the offload pool, since parsed
+        queries hold lambdas and can't be sent to it. """
+    return exec_query(query.parse_query(text))
+
+def search_awake(text):
+    """ search, and whether the query asked for the awakened card. """
+    parsed = query.parse_query(text)
+    return exec_query(parsed), parsed.is_awake
+
 def exec_query_direct(query):
-    conn = sqlite3.connect("drst_search_index.db")
+    conn = search_connection()
     cards = conn.execute("SELECT *, 0 FROM cards_v1 WHERE root_id = ? OR awakened_id = ?", (query.id, query.id))
 
     row = cards.fetchone()
-    conn.close()
 
     if row is None:
         raise InvalidQueryError("That card doesn't exist, nya.")
@@ -210,7 +240,7 @@ def exec_query_direct(query):
         return [filterable_card_data_t(*row)]
 
 def exec_query_search(query):
-    conn = sqlite3.connect("drst_search_index.db")
+    conn = search_connection()
 
     restrict_char_id = chara_id_from_name(conn, query.keywords[-2:])
     consumed = 2
@@ -246,8 +276,6 @@ def exec_query_search(query):
 
     cards = list(starmap(filterable_card_data_t, cards.fetchall()))
 
-    conn.close()
-
     cards = list(filter(lambda x: all(f(x) for f in query.filters), cards))
 
     if query.ordinal:
@@ -2,6 +2,8 @@ import config
 import pytz
 import peony
 import re
+import async_timeout
+import deadlines
 from . import httputils
 from datetime import datetime
 
@@ -124,7 +126,10 @@ class EventReader(object):
         req = self.twitter.api.statuses.user_timeline.get(
             count=20, screen_name=user, include_rts=False, tweet_mode="extended")
 
-        for tweet in await req:
+        with async_timeout.timeout(deadlines.remaining(15)):
+            tweets = await req
+
+        for tweet in tweets:
             p = self.parse_predictor_tweet(tweet.full_text)
             if p:
                 break
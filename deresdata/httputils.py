@@ -3,11 +3,12 @@ import async_timeout
 import asyncio
 import time
 import json
+import deadlines
 
 async def cfetch(url):
     t = time.time()
 
-    with async_timeout.timeout(20):
+    with async_timeout.timeout(deadlines.remaining(20)):
         async with aiohttp.get(url) as response:
             rsp = await response.json()
             print("cfetch({0}): completed in {1} s".format(url, time.time() - t))
@@ -20,7 +21,7 @@ async def ctlstrings(strings):
     t = time.time()
 
     try:
-        with async_timeout.timeout(10):
+        with async_timeout.timeout(deadlines.remaining(10)):
             async with aiohttp.post("https://starlight.kirara.ca/api/v1/read_tl",
                                     data=json.dumps(strings)) as response:
                 rsp = await response.json()
@@ -1,42 +1,296 @@
-import sqlite3
+import asyncio
+import asyncdb
+import config
+import hashlib
+import os
+import time
 import traceback
+import zlib
+from collections import deque
+
+MIGRATIONS = [
+    """CREATE TABLE IF NOT EXISTS
+        error_v1 (
+            _server_id TEXT,
+            _user_id TEXT,
+            _invocation TEXT,
+            _classname TEXT,
+            _description TEXT,
+            _trace TEXT
+        );
+        CREATE TABLE IF NOT EXISTS
+        invalid_command_v1 (
+            _server_id TEXT,
+            _user_id TEXT,
+            _invocation TEXT
+        )
+    """,
+    # Errors are grouped by fingerprint. error_v1 is no longer written
+    # to; its rows are left alone for whoever still wants to read them.
+    """CREATE TABLE error_group_v1 (
+            _fingerprint TEXT PRIMARY KEY,
+            _classname TEXT,
+            _description TEXT,
+            _trace BLOB,
+            _count INTEGER,
+            _first_seen INTEGER,
+            _last_seen INTEGER
+        );
+        CREATE INDEX error_group_v1_last_seen ON error_group_v1 (_last_seen);
+        CREATE TABLE error_hourly_v1 (
+            _hour INTEGER,
+            _fingerprint TEXT,
+            _count INTEGER,
+            PRIMARY KEY (_hour, _fingerprint)
+        ) WITHOUT ROWID;
+        CREATE TABLE error_sample_v1 (
+            _fingerprint TEXT,
+            _time INTEGER,
+            _server_id TEXT,
+            _user_id TEXT,
+            _invocation TEXT
+        );
+        CREATE INDEX error_sample_v1_fingerprint ON error_sample_v1 (_fingerprint, _time);
+        CREATE INDEX error_sample_v1_time ON error_sample_v1 (_time)
+    """,
+]
+
+TABLE_ERROR = "error_group_v1"
+TABLE_INVALID_COMMAND = "invalid_command_v1"
+
+INSERTS = {
+    TABLE_INVALID_COMMAND: "INSERT INTO invalid_command_v1 VALUES (?, ?, ?)",
+}
+
+# A group's first trace is kept; later occurrences only bump the counters.
+INSERT_GROUP = "INSERT OR IGNORE INTO error_group_v1 VALUES (?, ?, ?, ?, 0, ?, ?)"
+UPDATE_GROUP = """UPDATE error_group_v1
+    SET _count = _count + ?, _last_seen = ?, _description = ?
+    WHERE _fingerprint = ?"""
+INSERT_HOUR = "INSERT OR IGNORE INTO error_hourly_v1 VALUES (?, ?, 0)"
+UPDATE_HOUR = "UPDATE error_hourly_v1 SET _count = _count + ? WHERE _hour = ? AND _fingerprint = ?"
+INSERT_SAMPLE = "INSERT INTO error_sample_v1 VALUES (?, ?, ?, ?, ?)"
+TRIM_SAMPLES = """DELETE FROM error_sample_v1 WHERE _fingerprint = ? AND rowid NOT IN (
+    SELECT rowid FROM error_sample_v1 WHERE _fingerprint = ?
+    ORDER BY _time DESC, rowid DESC LIMIT ?)"""
+
+TOP_ERRORS = """SELECT h._fingerprint, SUM(h._count) AS n, g._classname, g._description, g._last_seen
+    FROM error_hourly_v1 h JOIN error_group_v1 g ON g._fingerprint = h._fingerprint
+    WHERE h._hour >= ?
+    GROUP BY h._fingerprint
+    ORDER BY n DESC
+    LIMIT ?"""
+
+def fingerprint(exception):
+    """ Identifies "the same error": the exception's class and the file and
+        function of every frame it passed through. Line numbers, messages
+        and anything else that changes between occurrences (or between
+        versions of the code) are left out. """
+
+    cls = exception.__class__
+    parts = ["{0}.{1}".format(cls.__module__, cls.__qualname__)]
+
+    for frame in traceback.extract_tb(exception.__traceback__):
+        parts.append("{0}:{1}".format(os.path.basename(frame.filename), frame.name))
+
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()[:16]
 
 class LogDB(object):
+    """ Log entries are queued in memory and written in batches by run(),
+        once logdb.batch_size of them are waiting or the oldest has waited
+        logdb.flush_interval seconds. If logdb.max_queued are waiting,
+        new entries are dropped and counted. close() writes what's left.
+
+        Errors are stored per fingerprint, with hourly counts and the last
+        logdb.samples_per_error invocations. prune_forever() deletes
+        what's older than logdb.retention_days. """
+
     def __init__(self, path):
-        connection = sqlite3.connect(path)
-        connection.executescript("""CREATE TABLE IF NOT EXISTS
-            error_v1 (
-                _server_id TEXT,
-                _user_id TEXT,
-                _invocation TEXT,
-                _classname TEXT,
-                _description TEXT,
-                _trace TEXT
-            );
-            CREATE TABLE IF NOT EXISTS
-            invalid_command_v1 (
-                _server_id TEXT,
-                _user_id TEXT,
-                _invocation TEXT
-            )
-        """)
-        connection.commit()
-
-        self.connection = connection
+        self.db = asyncdb.open_database(path, MIGRATIONS)
+
+        # (table, row)
+        self.queue = deque()
+        # set while anything is queued / once a full batch is
+        self.arrived = asyncio.Event()
+        self.filled = asyncio.Event()
+        self.writing = None
+        self.written = 0
+        self.dropped = 0
+
+        self.reload()
+
+    def reload(self):
+        self.max_queued = config.get("logdb.max_queued", 1000)
+        self.batch_size = config.get("logdb.batch_size", 50)
+        self.flush_interval = config.get("logdb.flush_interval", 2.0)
+        self.samples_per_error = config.get("logdb.samples_per_error", 5)
+        self.retention_days = config.get("logdb.retention_days", 30)
+        self.prune_interval = config.get("logdb.prune_interval", 3600)
+
+    def enqueue(self, table, row):
+        if len(self.queue) >= self.max_queued:
+            self.dropped += 1
+            return
+
+        self.queue.append((table, row))
+        self.arrived.set()
+        if len(self.queue) >= self.batch_size:
+            self.filled.set()
 
     def log_current_error(self, original_msg, exception):
+        """ Call from inside the except block, the trace is formatted here. """
+
         server_id = original_msg.server.id if original_msg.server else ":DM"
 
-        self.connection.execute("INSERT INTO error_v1 VALUES (?, ?, ?, ?, ?, ?)",
-            (server_id, "{0}:{1}".format(original_msg.author.name, original_msg.author.id),
-             original_msg.content, exception.__class__.__name__, str(exception),
-             traceback.format_exc()))
-        self.connection.commit()
+        self.enqueue(TABLE_ERROR,
+            (fingerprint(exception), exception.__class__.__name__, str(exception),
+             traceback.format_exc(), int(time.time()),
+             server_id, "{0}:{1}".format(original_msg.author.name, original_msg.author.id),
+             original_msg.content))
 
     def log_invalid_command(self, original_msg):
         server_id = original_msg.server.id if original_msg.server else ":DM"
 
-        self.connection.execute("INSERT INTO invalid_command_v1 VALUES (?, ?, ?, ?, ?, ?)",
+        self.enqueue(TABLE_INVALID_COMMAND,
             (server_id, "{0}:{1}".format(original_msg.author.name, original_msg.author.id),
              original_msg.content))
-        self.connection.commit()
+
+    async def write_batch(self):
+        batch = []
+        while self.queue and len(batch) < self.batch_size:
+            batch.append(self.queue.popleft())
+
+        rows = {}
+        for table, row in batch:
+            rows.setdefault(table, []).append(row)
+
+        for table, table_rows in rows.items():
+            if table == TABLE_ERROR:
+                await self.write_errors(table_rows)
+            else:
+                await self.db.executemany(INSERTS[table], table_rows)
+
+        self.written += len(batch)
+
+    async def write_errors(self, rows):
+        """ Folds the batch's occurrences into one update per group and
+            hour before writing them. """
+
+        groups = {}
+        hours = {}
+        samples = {}
+
+        for fp, classname, description, trace, when, server_id, user_id, invocation in rows:
+            group = groups.get(fp)
+            if group is None:
+                groups[fp] = [classname, description, trace, when, when, 1]
+            else:
+                group[1] = description
+                group[4] = when
+                group[5] += 1
+
+            hour = when // 3600
+            hours[hour, fp] = hours.get((hour, fp), 0) + 1
+
+            fp_samples = samples.setdefault(fp, deque(maxlen=self.samples_per_error))
+            fp_samples.append((fp, when, server_id, user_id, invocation))
+
+        await self.db.executemany(INSERT_GROUP,
+            [(fp, classname, description, zlib.compress(trace.encode("utf-8")), first, last)
+             for fp, (classname, description, trace, first, last, _) in groups.items()])
+        await self.db.executemany(UPDATE_GROUP,
+            [(count, last, description, fp)
+             for fp, (_, description, _, _, last, count) in groups.items()])
+
+        await self.db.executemany(INSERT_HOUR, list(hours))
+        await self.db.executemany(UPDATE_HOUR,
+            [(count, hour, fp) for (hour, fp), count in hours.items()])
+
+        await self.db.executemany(INSERT_SAMPLE,
+            [sample for fp_samples in samples.values() for sample in fp_samples])
+        await self.db.executemany(TRIM_SAMPLES,
+            [(fp, fp, self.samples_per_error) for fp in samples])
+
+    async def prune(self):
+        cutoff = int(time.time()) - self.retention_days * 86400
+
+        await self.db.execute("DELETE FROM error_hourly_v1 WHERE _hour < ?", (cutoff // 3600,))
+        await self.db.execute("DELETE FROM error_sample_v1 WHERE _time < ?", (cutoff,))
+        return await self.db.execute("DELETE FROM error_group_v1 WHERE _last_seen < ?", (cutoff,))
+
+    async def prune_forever(self):
+        """ Runs forever, calling prune every logdb.prune_interval seconds. """
+
+        while 1:
+            await asyncio.sleep(self.prune_interval)
+
+            try:
+                await self.prune()
+            except Exception as e:
+                print("LogDB: pruning failed:", repr(e))
+
+    async def top_errors(self, hours, limit=10):
+        """ (fingerprint, count, classname, description, last seen) of
+            the groups seen most often in the last hours hours. """
+
+        since = int(time.time()) // 3600 - hours + 1
+        return await self.db.query(TOP_ERRORS, (since, limit))
+
+    async def error_details(self, fp):
+        """ (fingerprint, classname, trace, count, first seen, last seen)
+            and the stored samples of the group whose fingerprint starts
+            with fp, or None. """
+
+        group = await self.db.query_one("""SELECT _fingerprint, _classname, _trace, _count, _first_seen, _last_seen
+            FROM error_group_v1 WHERE _fingerprint >= ? AND _fingerprint < ? LIMIT 1""",
+            (fp, fp + "\uffff"))
+
+        if group is None:
+            return None
+
+        samples = await self.db.query("""SELECT _time, _server_id, _user_id, _invocation
+            FROM error_sample_v1 WHERE _fingerprint = ? ORDER BY _time DESC""", (group[0],))
+
+        fp, classname, trace, count, first_seen, last_seen = group
+        return (fp, classname, zlib.decompress(trace).decode("utf-8"), count, first_seen, last_seen), samples
+
+    async def run(self):
+        """ Runs forever, writing queued entries. """
+
+        while 1:
+            await self.arrived.wait()
+
+            if len(self.queue) < self.batch_size:
+                try:
+                    await asyncio.wait_for(self.filled.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+            # if we're cancelled mid-write, the batch is still written
+            # and close() waits for it
+            self.writing = asyncio.ensure_future(self.write_batch())
+            try:
+                await asyncio.shield(self.writing)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print("LogDB: writing a batch failed:", repr(e))
+
+            if len(self.queue) < self.batch_size:
+                self.filled.clear()
+            if not self.queue:
+                self.arrived.clear()
+
+    async def close(self):
+        try:
+            if self.writing is not None and not self.writing.done():
+                await self.writing
+
+            while self.queue:
+                await self.write_batch()
+        except Exception as e:
+            print("LogDB: lost", len(self.queue), "entries on shutdown:", repr(e))
+
+    def describe(self):
+        return "written: {0}, queued: {1}/{2}, dropped: {3}".format(
+            self.written, len(self.queue), self.max_queued, self.dropped)
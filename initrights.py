@@ -1,5 +1,7 @@
 import auth
 import sys
+import asyncio
+import asyncdb
 
 def main():
     if len(sys.argv) < 2:
@@ -8,7 +10,9 @@ def main():
     subject = sys.argv[1]
 
     db = auth.RightsDB("rights.db")
-    db.write_permission(auth.SCOPE_USER, subject, auth.declare_right("MANAGE_PERMISSIONS"), 1)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(db.write_permission(auth.SCOPE_USER, subject, auth.declare_right("MANAGE_PERMISSIONS"), 1))
+    asyncdb.close_all()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,114 @@
+import asyncio
+import os
+import sys
+import time
+import config
+import coordination
+
+# Runs the bot as launcher.shard_count worker processes. Worker N runs
+# bot.py as shard N of launcher.shard_count, and is restarted whenever it
+# exits. Workers publish changes to shared state through a unix socket
+# that this process relays to every other worker (see coordination.py).
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+
+class Relay(object):
+    """ Forwards each line a worker sends to all the other workers. """
+
+    def __init__(self):
+        self.writers = set()
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+
+        try:
+            while 1:
+                line = await reader.readline()
+                if not line:
+                    break
+
+                for other in self.writers:
+                    if other is not writer:
+                        other.write(line)
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+class Worker(object):
+    def __init__(self, shard_id, shard_count, socket_path):
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.socket_path = socket_path
+        self.process = None
+        self.restarts = 0
+
+    def environment(self):
+        env = dict(os.environ)
+        env["BOT_SHARD_ID"] = str(self.shard_id)
+        env["BOT_SHARD_COUNT"] = str(self.shard_count)
+        env[coordination.SOCKET_ENV] = self.socket_path
+        return env
+
+    async def supervise(self):
+        """ Keep the worker running. Workers that die soon after starting
+            are restarted with an increasing delay. """
+
+        delay = config.get("launcher.restart_delay", 5)
+        max_delay = config.get("launcher.max_restart_delay", 300)
+        backoff = delay
+
+        while 1:
+            started = time.monotonic()
+            self.process = await asyncio.create_subprocess_exec(sys.executable, BOT_SCRIPT,
+                env=self.environment())
+            print("supervise: shard", self.shard_id, "started as pid", self.process.pid)
+
+            code = await self.process.wait()
+            self.process = None
+
+            if time.monotonic() - started >= config.get("launcher.stable_after", 60):
+                backoff = delay
+
+            self.restarts += 1
+            print("supervise: shard {0} exited with status {1}, restarting in {2} s".format(
+                self.shard_id, code, backoff))
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, max_delay)
+
+    async def stop(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+
+def main():
+    shard_count = config.get("launcher.shard_count", 1)
+    socket_path = config.get("launcher.socket_path", "coordination.sock")
+
+    loop = asyncio.get_event_loop()
+    relay = Relay()
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    server = loop.run_until_complete(asyncio.start_unix_server(relay.handle, socket_path))
+    workers = [Worker(shard_id, shard_count, os.path.abspath(socket_path))
+               for shard_id in range(shard_count)]
+    tasks = [loop.create_task(worker.supervise()) for worker in workers]
+
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.run_until_complete(asyncio.gather(*[worker.stop() for worker in workers]))
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
+        os.unlink(socket_path)
+
+if __name__ == '__main__':
+    main()
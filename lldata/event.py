@@ -1,4 +1,6 @@
 import aiohttp
+import async_timeout
+import deadlines
 from collections import namedtuple
 
 event_t = namedtuple("event_t",
@@ -15,8 +17,9 @@ def safe_int(k):
         return k
 
 async def llsif_fetch_eventinfo():
-    async with aiohttp.get("http://llsif.net/data/event_info.json") as r:
-        ei_struct = await r.json()
+    with async_timeout.timeout(deadlines.remaining(20)):
+        async with aiohttp.get("http://llsif.net/data/event_info.json") as r:
+            ei_struct = await r.json()
 
     en_e = None
     jp_e = None
@@ -31,8 +34,9 @@ async def llsif_fetch_eventinfo():
             "EN": en_e}
 
 async def llsif_fetch_real_cutoffs(sid, event_id):
-    async with aiohttp.get("http://llsif.net/data/{0}/{1}.csv".format(sid, event_id)) as r:
-        the_csv = await r.text()
+    with async_timeout.timeout(deadlines.remaining(20)):
+        async with aiohttp.get("http://llsif.net/data/{0}/{1}.csv".format(sid, event_id)) as r:
+            the_csv = await r.text()
 
     fl_index = the_csv.rfind("\n", 0, len(the_csv) - 5)
     fl2_index = the_csv.rfind("\n", 0, fl_index - 1)
@@ -1,7 +1,13 @@
 import os
 import sys
+import json
 import config
 import inspect
+import hashlib
+import tempfile
+import asyncio
+import auth
+import command_object
 from command_object import Command, DefaultModuleContext
 
 LOADING_MODULE = None
@@ -9,12 +15,18 @@ LOADED_MODULES = set()
 MODULE_CONTEXT_CLASSES = {}
 MANAGED_COMMAND_PACKAGE = config.get("bot.commands_package", "commands")
 MANAGED_COMMAND_PACKAGE_PATH = os.path.dirname(__import__(MANAGED_COMMAND_PACKAGE).__file__)
+MANIFEST_PATH = config.get("bot.command_manifest_path", "command_manifest.json")
+# leaf name -> what load_module saw the last time it imported the module.
+# See describe_module.
+MANIFEST = {}
+LAZY_LOAD_LOCKS = {}
 
 ROOT_COMMAND      = Command("")
 command           = ROOT_COMMAND.subcommand
 register_command  = ROOT_COMMAND.register_subcommand
 delete_command    = ROOT_COMMAND.delete_subcommand
 is_usable_command = ROOT_COMMAND.is_subcommand_or_alias
+set_fallback      = ROOT_COMMAND.set_fallback
 
 def localname(name):
     return name[len(MANAGED_COMMAND_PACKAGE) + 1:]
@@ -32,23 +44,216 @@ def get_context_class(modobject):
 def fq_from_leaf(name):
     return ".".join((MANAGED_COMMAND_PACKAGE, name))
 
+class StubCommand(Command):
+    """ Stands in for a top-level command of a module that hasn't been
+        imported yet. The first dispatch imports and inits the module, then
+        dispatches the message again against the real commands. """
+
+    def __init__(self, module_name, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.module_name = module_name
+        self.provider = fq_from_leaf(module_name)
+
+    async def dispatch(self, context, message, effective_content):
+        await ensure_loaded(self.module_name, context.of("discordbot"))
+
+        # the stub is only ever at the root, so arg0 is just the word used
+        if effective_content:
+            effective_content = " ".join((context.arg0, effective_content))
+        else:
+            effective_content = context.arg0
+
+        context.arg0 = ""
+        await ROOT_COMMAND.dispatch(context, message, effective_content)
+
+def file_digest(path):
+    hash = hashlib.sha256()
+    with open(path, "rb") as srcfile:
+        hash.update(srcfile.read())
+
+    return hash.hexdigest()
+
+def describe_command(cmd):
+    return {
+        "word": cmd.word,
+        "extwords": list(cmd.extwords),
+        "description": cmd.description,
+        "synopsis": cmd.synopsis,
+        "examples": cmd.examples,
+        "hide": cmd.is_hidden,
+        "right": cmd.required_right.name if cmd.required_right else None,
+        "subcommands": [describe_command(sub) for sub in cmd.sub_dispatch_table.values()],
+    }
+
+def describe_module(mod):
+    """ Everything needed to stand in for mod without importing it. """
+
+    fq = mod.__name__
+
+    return {
+        "digest": file_digest(mod.__file__),
+        # modules that do work in init_with_context must be loaded up front
+        "lazy": not hasattr(get_context_class(mod), "init_with_context"),
+        "rights": sorted(v.name for v in vars(mod).values() if isinstance(v, auth.flag_t)),
+        "commands": [describe_command(cmd) for cmd in ROOT_COMMAND.sub_dispatch_table.values()
+                     if cmd.provider == fq],
+    }
+
+def read_manifest():
+    try:
+        with open(MANIFEST_PATH, "r") as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest():
+    # every shard may write the manifest at once, so each goes through
+    # its own temporary file; the last os.replace wins whole
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(MANIFEST_PATH)),
+                                     prefix=os.path.basename(MANIFEST_PATH) + ".", suffix=".tmp",
+                                     delete=False) as manifest_file:
+        try:
+            json.dump(MANIFEST, manifest_file, indent=1, sort_keys=True)
+        except Exception:
+            manifest_file.close()
+            os.unlink(manifest_file.name)
+            raise
+
+    os.replace(manifest_file.name, MANIFEST_PATH)
+
+def stub_from_description(parent, desc, module_name):
+    kwargs = {"description": desc["description"], "synopsis": desc["synopsis"],
+              "examples": desc["examples"], "hide": desc["hide"]}
+
+    if parent is ROOT_COMMAND:
+        cmd = StubCommand(module_name, desc["word"], *desc["extwords"], **kwargs)
+        cmd.parent = parent
+        parent.delete_subcommand(cmd.word)
+        parent.sub_dispatch_table[cmd.word] = cmd
+        parent.index_aliases(cmd)
+    else:
+        # only used for help and Command.resolve; the root stub dispatches
+        cmd = parent.register_subcommand(desc["word"], *desc["extwords"], **kwargs)
+
+    if desc["right"]:
+        cmd.required_right = auth.declare_right(desc["right"])
+
+    for sub in desc["subcommands"]:
+        stub_from_description(cmd, sub, module_name)
+
+def register_stubs(name, entry):
+    for right in entry["rights"]:
+        auth.declare_right(right)
+
+    for desc in entry["commands"]:
+        stub_from_description(ROOT_COMMAND, desc, name)
+
+    command_object.bump_tree_version()
+
+def remove_stubs(name):
+    """ Remove the stub commands of a module that was never imported.
+        Returns whether there were any. """
+
+    fq = fq_from_leaf(name)
+    found = 0
+
+    for key in list(ROOT_COMMAND.sub_dispatch_table.keys()):
+        cmd = ROOT_COMMAND.sub_dispatch_table[key]
+        if isinstance(cmd, StubCommand) and cmd.provider == fq:
+            ROOT_COMMAND.delete_subcommand(key)
+            found = 1
+
+    return found
+
 def load_modules():
+    """ Import every module in the command package, except that modules
+        that are unchanged since the manifest was written and can be
+        loaded lazily only get stub commands. """
+
+    previous = read_manifest()
+    lazy_ok = config.get("bot.lazy_load_modules", 1)
+
     for a_file in os.listdir(MANAGED_COMMAND_PACKAGE_PATH):
-        modulename = inspect.getmodulename(os.path.join(MANAGED_COMMAND_PACKAGE_PATH, a_file))
+        path = os.path.join(MANAGED_COMMAND_PACKAGE_PATH, a_file)
+        modulename = inspect.getmodulename(path)
+
         if modulename:
-            print("load_modules: importing", modulename)
-            load_module(modulename)
+            entry = previous.get(modulename)
+
+            if lazy_ok and entry and entry["lazy"] and entry["digest"] == file_digest(path):
+                print("load_modules: deferring", modulename)
+                MANIFEST[modulename] = entry
+                register_stubs(modulename, entry)
+            else:
+                print("load_modules: importing", modulename)
+                load_module(modulename, save_manifest=0)
+
+    write_manifest()
+
+async def ensure_loaded(name, bot):
+    """ Import and init a lazily loaded module, if it isn't already. """
+
+    fq = fq_from_leaf(name)
+    lock = LAZY_LOAD_LOCKS.setdefault(fq, asyncio.Lock())
 
-def load_module(name):
+    async with lock:
+        if fq in sys.modules:
+            return
+
+        print("ensure_loaded: importing", name, "on first use")
+        mod = load_module(name)
+
+        try:
+            await bot.init_module(mod)
+        except Exception:
+            unload_module(name)
+            raise
+
+def find_dependency_cycles(deps):
+    """ deps maps a name to the names it must come after. Returns the
+        names that are part of, or wait on, a cycle. """
+
+    state = {}
+    bad = set()
+
+    def visit(name):
+        if state.get(name) == 1:
+            return 1
+        if state.get(name) == 2:
+            return name in bad
+
+        state[name] = 1
+        cyclic = 0
+        for dep in deps.get(name, ()):
+            if visit(dep):
+                cyclic = 1
+        state[name] = 2
+
+        if cyclic:
+            bad.add(name)
+        return cyclic
+
+    for name in deps:
+        visit(name)
+
+    return bad
+
+def load_module(name, save_manifest=1):
     global LOADING_MODULE
 
     fq = fq_from_leaf(name)
+    remove_stubs(name)
 
     LOADING_MODULE = fq
     mod = getattr(__import__(fq), name)
     LOADED_MODULES.add(mod)
 
     LOADING_MODULE = None
+    command_object.bump_tree_version()
+
+    MANIFEST[name] = describe_module(mod)
+    if save_manifest:
+        write_manifest()
 
     return mod
 
@@ -59,7 +264,10 @@ def unload_module(name):
     # remove its registered commands
     for key in list(ROOT_COMMAND.sub_dispatch_table.keys()):
         if ROOT_COMMAND.sub_dispatch_table[key].provider == fq:
-            del ROOT_COMMAND.sub_dispatch_table[key]
+            ROOT_COMMAND.delete_subcommand(key)
+
+    if ROOT_COMMAND.fallback is not None and ROOT_COMMAND.fallback[1].provider == fq:
+        ROOT_COMMAND.clear_fallback()
 
     # remove its context class
     try:
@@ -70,3 +278,4 @@ def unload_module(name):
     LOADED_MODULES.remove(getattr(package, name))
     delattr(package, name)
     del sys.modules[fq]
+    command_object.bump_tree_version()
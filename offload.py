@@ -0,0 +1,101 @@
+import asyncio
+import os
+import config
+import deadlines
+from concurrent.futures import ProcessPoolExecutor
+
+# Runs CPU-heavy, pure-Python work in a pool of worker processes so it
+# doesn't hold up the event loop. The function and its arguments are
+# pickled, so the function has to be importable at module level and the
+# arguments plain data (no lambdas, contexts, connections...).
+
+class OffloadBusyError(Exception):
+    pass
+
+class ProcessOffloader(object):
+    """ A lazily started process pool with a cap on the number of tasks
+        waiting for it. DiscordBot owns one and shuts it down on exit. """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.executor = None
+        self.pending = 0
+        self.completed = 0
+        self.timed_out = 0
+        self.rejected = 0
+
+        self.reload()
+
+    def reload(self):
+        self.workers = config.get("offload.workers", os.cpu_count() or 2)
+        self.max_pending = config.get("offload.max_pending", 32)
+        self.timeout = config.get("offload.timeout", 30)
+
+    async def run(self, func, *args, timeout=None):
+        """ Run func(*args) in a worker process and return its result.
+            Raises asyncio.TimeoutError after timeout seconds (offload.timeout
+            by default, and never past the current task's deadline), or
+            OffloadBusyError if too many tasks are already waiting. """
+
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise OffloadBusyError()
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(self.workers)
+
+        # raises DeadlineExceeded before anything is started if the
+        # command has no time left
+        wait = deadlines.remaining(timeout or self.timeout)
+
+        self.pending += 1
+        future = self.loop.run_in_executor(self.executor, func, *args)
+        future.add_done_callback(self.job_finished)
+
+        try:
+            # a task that has already started can't be stopped; it keeps
+            # its worker busy until it returns, so it stays pending until
+            # then and we just stop waiting
+            result = await asyncio.wait_for(asyncio.shield(future), wait)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise
+
+        self.completed += 1
+        return result
+
+    def job_finished(self, future):
+        self.pending -= 1
+
+        # nobody is waiting for a job that timed out, so retrieve its
+        # exception here rather than have asyncio complain about it
+        if not future.cancelled():
+            future.exception()
+
+    def shutdown(self):
+        """ Let running tasks finish and stop the worker processes. """
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def describe(self):
+        return "workers: {0}{1}, waiting: {2}/{3}, completed: {4}, timed out: {5}, rejected: {6}".format(
+            self.workers, "" if self.executor is not None else " (not started)",
+            self.pending, self.max_pending, self.completed, self.timed_out, self.rejected)
+
+_offloader = None
+
+def install(offloader):
+    global _offloader
+    _offloader = offloader
+
+async def run(func, *args, timeout=None):
+    """ Run func(*args) on the installed ProcessOffloader. Without one
+        (e.g. in a script that imports deresdata directly) it's just
+        called inline. """
+
+    if _offloader is None:
+        return func(*args)
+
+    return await _offloader.run(func, *args, timeout=timeout)
@@ -0,0 +1,149 @@
+import asyncio
+import time
+import config
+from collections import deque
+from ratelimit import TokenBucket
+
+MAX_MESSAGE_LENGTH = 2000
+
+class PendingMessage(object):
+    __slots__ = ("content", "embed", "futures")
+
+    def __init__(self, content, embed, future):
+        self.content = content
+        self.embed = embed
+        self.futures = [future]
+
+class ChannelQueue(object):
+    __slots__ = ("channel", "items", "bucket", "worker")
+
+    def __init__(self, channel, bucket):
+        self.channel = channel
+        self.items = deque()
+        self.bucket = bucket
+        self.worker = None
+
+def retrieve_exception(future):
+    # drain logs send failures; most callers never await the future,
+    # so mark its exception retrieved to keep asyncio quiet
+    if not future.cancelled():
+        future.exception()
+
+class OutboundQueue(object):
+    """ Per-channel queues in front of client.send_message.
+        Each channel gets a token bucket mirroring Discord's per-channel
+        message limit (outbound.burst messages every outbound.period
+        seconds), so bursts wait here instead of running into 429s.
+        Text-only messages that pile up while we wait are merged, up to
+        the 2000 character limit. """
+
+    def __init__(self, client):
+        self.client = client
+        self.channels = {}
+        self.sent = 0
+        self.merged = 0
+
+        self.reload()
+
+    def reload(self):
+        self.burst = config.get("outbound.burst", 5)
+        self.period = config.get("outbound.period", 5.0)
+
+    def send(self, channel, content=None, *, embed=None):
+        """ Queue a message. Returns a future for the discord.Message it
+            ends up being part of. """
+
+        cq = self.channels.get(channel.id)
+        if cq is None:
+            if len(self.channels) >= 512:
+                self.evict_idle()
+
+            cq = ChannelQueue(channel, TokenBucket(self.burst, self.period, time.monotonic()))
+            self.channels[channel.id] = cq
+
+        future = self.client.loop.create_future()
+        future.add_done_callback(retrieve_exception)
+        cq.items.append(PendingMessage(content, embed, future))
+
+        if cq.worker is None:
+            cq.worker = self.client.loop.create_task(self.drain(cq))
+
+        return future
+
+    def coalesce(self, items):
+        first = items.popleft()
+
+        if first.embed is not None or first.content is None:
+            return first
+
+        parts = [first.content]
+        length = len(first.content)
+
+        while items:
+            nxt = items[0]
+
+            if nxt.embed is not None or nxt.content is None or \
+               length + 1 + len(nxt.content) > MAX_MESSAGE_LENGTH:
+                break
+
+            items.popleft()
+            parts.append(nxt.content)
+            length += 1 + len(nxt.content)
+            first.futures.extend(nxt.futures)
+            self.merged += 1
+
+        first.content = "\n".join(parts)
+        return first
+
+    async def drain(self, cq):
+        try:
+            while cq.items:
+                delay = cq.bucket.delay(time.monotonic())
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+                pending = self.coalesce(cq.items)
+                cq.bucket.take()
+
+                try:
+                    msg = await self.client.send_message(cq.channel, pending.content, embed=pending.embed)
+                except Exception as e:
+                    print("outbound: sending to channel {0} failed: {1!r}".format(cq.channel.id, e))
+                    for future in pending.futures:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    self.sent += 1
+                    for future in pending.futures:
+                        if not future.done():
+                            future.set_result(msg)
+        finally:
+            cq.worker = None
+
+    async def flush(self):
+        """ Wait up to outbound.flush_timeout seconds for every queued
+            message to be sent. Call it on shutdown, while the client is
+            still connected and before the workers are cancelled. """
+
+        workers = [cq.worker for cq in self.channels.values() if cq.worker is not None]
+
+        if workers:
+            await asyncio.wait(workers, timeout=config.get("outbound.flush_timeout", 5))
+
+        unsent = sum(len(cq.items) for cq in self.channels.values())
+        if unsent:
+            print("outbound: dropping", unsent, "unsent message(s) on shutdown")
+
+    def evict_idle(self):
+        now = time.monotonic()
+
+        for key in [k for k, cq in self.channels.items()
+                    if cq.worker is None and not cq.items and cq.bucket.is_idle(now)]:
+            del self.channels[key]
+
+    def describe(self):
+        busy = sum(1 for cq in self.channels.values() if cq.items)
+
+        return "sent: {0}, merged into other messages: {1}, channels with queued messages: {2}".format(
+            self.sent, self.merged, busy)
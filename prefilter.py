@@ -0,0 +1,93 @@
+import re
+import discord
+import config
+from collections import Counter
+
+# Rejection stages, in the order on_message checks them.
+STAGE_NOT_READY       = "not_ready"
+STAGE_FROM_BOT        = "from_bot"
+STAGE_IGNORED_SERVER  = "ignored_server"
+STAGE_IGNORED_CHANNEL = "ignored_channel"
+STAGE_NO_ATTENTION    = "no_attention"
+STAGE_ACCEPTED        = "accepted"
+
+def mention_needed_for(m):
+    # commands without attention_char or @ are allowed in 1-to-1 DMs.
+    if isinstance(m.channel, discord.PrivateChannel) and len(m.channel.recipients) == 1:
+        return 0
+
+    return 1
+
+class MessagePrefilter(object):
+    """ Decides whether a message could be a command before the bot
+        spends anything on it. Everything check() looks at is held in
+        memory; call reload() after changing the global bot.* config keys. """
+
+    def __init__(self):
+        self.stats = Counter()
+        self.user_id = None
+        self.attention_char = "="
+        self.attention_regexes = {}
+        self.ignored_servers = set()
+        self.ignored_channels = set()
+
+        self.reload()
+
+    def set_user(self, user_id):
+        self.user_id = user_id
+        self.reload()
+
+    def reload(self):
+        self.ignored_servers = set(config.get("bot.ignored_servers", []))
+        self.ignored_channels = set(config.get("bot.ignored_channels", []))
+
+        self.attention_char = config.get("bot.attention_char", "=")
+        self.attention_regexes = {}
+
+    def attention_regex_for(self, message):
+        """ The compiled mention-or-prefix matcher for the message's channel.
+            Servers and channels can override bot.attention_char. """
+
+        server_id = message.server.id if message.server else None
+        ak = config.get_override("bot.attention_char", server_id, message.channel.id,
+            self.attention_char)
+
+        regex = self.attention_regexes.get(ak)
+        if regex is None:
+            regex = re.compile(r"<@!?{0}>|{1}".format(self.user_id, re.escape(ak)))
+            self.attention_regexes[ak] = regex
+
+        return regex
+
+    def reject(self, stage):
+        self.stats[stage] += 1
+        return None
+
+    def check(self, message):
+        """ Return the content of message with the attention prefix
+            removed, or None if it can't be a command. """
+
+        if self.user_id is None:
+            return self.reject(STAGE_NOT_READY)
+
+        if message.author.bot or \
+           message.channel.is_private and message.author.id == self.user_id:
+            return self.reject(STAGE_FROM_BOT)
+
+        if message.server is not None and message.server.id in self.ignored_servers:
+            return self.reject(STAGE_IGNORED_SERVER)
+
+        if message.channel.id in self.ignored_channels:
+            return self.reject(STAGE_IGNORED_CHANNEL)
+
+        match = self.attention_regex_for(message).match(message.content)
+        if match:
+            self.stats[STAGE_ACCEPTED] += 1
+            return message.content[match.end(0):].lstrip()
+
+        # TODO: should allow the prefix to be used even in DMs
+        if mention_needed_for(message):
+            return self.reject(STAGE_NO_ATTENTION)
+
+        self.stats[STAGE_ACCEPTED] += 1
+        return message.content.lstrip()
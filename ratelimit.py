@@ -0,0 +1,136 @@
+import time
+import config
+from collections import Counter
+
+# Scopes a limit can apply to. Pass a dict of scope -> (capacity, period)
+# as the ratelimit= argument when registering a command.
+SCOPE_USER    = "user"
+SCOPE_CHANNEL = "channel"
+SCOPE_SERVER  = "server"
+
+class TokenBucket(object):
+    """ Holds up to capacity tokens and regains capacity tokens every
+        period seconds. """
+    __slots__ = ("capacity", "rate", "tokens", "stamp")
+
+    def __init__(self, capacity, period, now):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = capacity
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def has_token(self, now):
+        self.refill(now)
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+    def delay(self, now):
+        """ Seconds until a token will be available. """
+        self.refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def is_idle(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+class RateLimiter(object):
+    """ Token buckets per (command name, scope, subject). Buckets that have
+        filled back up carry no state, so they're evicted periodically.
+        Everything is keyed by qualified command name rather than by
+        Command, so a reloaded module's commands pick up where the old
+        ones left off and the old objects aren't kept alive. """
+
+    def __init__(self):
+        self.buckets = {}
+        # qualified name -> (registration limits, effective limits)
+        self.limits = {}
+        self.throttled = Counter()
+        self.last_eviction = time.monotonic()
+
+        self.reload()
+
+    def reload(self):
+        """ Called when a ratelimit.* key changes. Limits are looked up
+            again, and admit resizes buckets whose limits changed. """
+        self.eviction_interval = config.get("ratelimit.eviction_interval", 120)
+        self.limits = {}
+
+    def limits_for(self, cmd):
+        """ The ratelimit.[command name] config key overrides the limits
+            given at registration, e.g. {"user": [2, 60]}. """
+
+        name = cmd.qualified_name()
+        cached = self.limits.get(name)
+
+        # a reloaded command may have been registered with other limits
+        if cached is None or cached[0] != cmd.ratelimit:
+            cached = self.limits[name] = (cmd.ratelimit, config.get("ratelimit." + name, cmd.ratelimit) or {})
+
+        return cached[1]
+
+    def subject_for(self, scope, message):
+        if scope == SCOPE_USER:
+            return message.author.id
+        elif scope == SCOPE_CHANNEL:
+            return message.channel.id
+        elif scope == SCOPE_SERVER:
+            return message.server.id if message.server else None
+
+    def admit(self, cmd, message):
+        """ Take a token from each of cmd's buckets for this message, or
+            none at all if any of them is empty. """
+
+        limits = self.limits_for(cmd)
+        if not limits:
+            return 1
+
+        now = time.monotonic()
+        if now - self.last_eviction >= self.eviction_interval:
+            self.evict_idle(now)
+
+        name = cmd.qualified_name()
+        buckets = []
+        for scope, (capacity, period) in limits.items():
+            subject = self.subject_for(scope, message)
+            if subject is None:
+                continue
+
+            key = (name, scope, subject)
+            bucket = self.buckets.get(key)
+            if bucket is None or bucket.capacity != capacity or bucket.rate != capacity / period:
+                bucket = self.buckets[key] = TokenBucket(capacity, period, now)
+
+            if not bucket.has_token(now):
+                self.throttled[scope] += 1
+                return 0
+
+            buckets.append(bucket)
+
+        for bucket in buckets:
+            bucket.take()
+
+        return 1
+
+    def evict_idle(self, now):
+        for key in [k for k, bucket in self.buckets.items() if bucket.is_idle(now)]:
+            del self.buckets[key]
+
+        self.last_eviction = now
+
+    def describe(self):
+        lines = ["buckets: {0}, commands with limits: {1}".format(
+            len(self.buckets), sum(1 for _, limits in self.limits.values() if limits))]
+
+        if self.throttled:
+            lines.append("throttled: " + ", ".join("{0}: {1}".format(scope, count)
+                for scope, count in self.throttled.most_common()))
+        else:
+            lines.append("throttled: none")
+
+        return "\n".join(lines)
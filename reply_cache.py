@@ -0,0 +1,109 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+# per decorated executor; least recently used entries are dropped first
+MAX_ENTRIES = 256
+
+class LeaderCancelled(Exception):
+    """ Set on the shared future when the invocation the others were
+        waiting for was cancelled. They then run it themselves. """
+    pass
+
+class RecordingContext(object):
+    """ Wraps a PersonalizedContext and remembers every reply made through it. """
+
+    def __init__(self, context):
+        object.__setattr__(self, "context", context)
+        object.__setattr__(self, "replies", [])
+
+    async def reply(self, msg=None, *, embed=None, mention=0):
+        self.replies.append((msg, embed, mention))
+        return await self.context.reply(msg, embed=embed, mention=mention)
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.context, name, value)
+
+def normalized_content(context, content):
+    return " ".join(content.lower().split())
+
+def retrieve_exception(future):
+    # keep asyncio from complaining when nobody was waiting
+    if not future.cancelled():
+        future.exception()
+
+async def replay(context, replies):
+    for msg, embed, mention in replies:
+        await context.reply(msg, embed=embed, mention=mention)
+
+def cached_reply(ttl, key=normalized_content):
+    """ Returns a decorator for command executors.
+        The replies an invocation makes are remembered for ttl seconds and
+        replayed for invocations with the same key (by default, the
+        arguments with case and whitespace normalized). If one is already
+        running, identical invocations wait for it instead of running too.
+
+        Only replies made with context.reply are cached. Put this below
+        auth.requires_right so rights are checked on every invocation.
+        Executors that look at context.arg0 should pass their own key. """
+
+    def wrapper(exec_):
+        # key -> (expiry, replies), oldest use first
+        entries = OrderedDict()
+        running = {}
+
+        async def cached(context, message, content):
+            k = key(context, content)
+
+            while 1:
+                entry = entries.get(k)
+                if entry is not None:
+                    if entry[0] > time.monotonic():
+                        entries.move_to_end(k)
+                        return await replay(context, entry[1])
+                    del entries[k]
+
+                in_progress = running.get(k)
+                if in_progress is None:
+                    break
+
+                try:
+                    return await replay(context, await asyncio.shield(in_progress))
+                except LeaderCancelled:
+                    # whoever was running it got cancelled (deadline,
+                    # reload, shutdown); go again, maybe as the leader
+                    continue
+
+            future = asyncio.get_event_loop().create_future()
+            future.add_done_callback(retrieve_exception)
+            running[k] = future
+
+            recorder = RecordingContext(context)
+            try:
+                await exec_(recorder, message, content)
+            except asyncio.CancelledError:
+                future.set_exception(LeaderCancelled())
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                raise
+            else:
+                now = time.monotonic()
+                if len(entries) >= MAX_ENTRIES:
+                    for stale in [sk for sk, (expiry, _) in entries.items() if expiry <= now]:
+                        del entries[stale]
+                while len(entries) >= MAX_ENTRIES:
+                    entries.popitem(last=False)
+
+                entries[k] = (now + ttl, recorder.replies)
+                future.set_result(recorder.replies)
+            finally:
+                del running[k]
+
+        cached.__name__ = exec_.__name__
+        return cached
+
+    return wrapper
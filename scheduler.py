@@ -0,0 +1,191 @@
+import asyncio
+import time
+import config
+from collections import OrderedDict, Counter, deque
+
+class QueueFullError(Exception):
+    """ Raised by CommandScheduler.run when the server's or the user's
+        queue is already at its limit. """
+    pass
+
+class PendingCommand(object):
+    __slots__ = ("server_key", "user_key", "future", "queued_at", "started")
+
+    def __init__(self, server_key, user_key, future):
+        self.server_key = server_key
+        self.user_key = user_key
+        self.future = future
+        self.queued_at = time.monotonic()
+        self.started = 0
+
+class CommandScheduler(object):
+    """ Admission control between on_message and dispatch.
+        Commands are queued per server and started round-robin across
+        servers, subject to per-user, per-server and global caps. """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+        # server key -> deque of PendingCommand. The order of keys is the
+        # round-robin ring: a server moves to the back after it gets a slot.
+        self.queues = OrderedDict()
+        self.running_servers = Counter()
+        self.running_users = Counter()
+        # user key -> commands waiting in any server's queue
+        self.queued_users = Counter()
+        self.in_flight = 0
+        self.queued = 0
+        self.refused = 0
+
+        self.loop_lag = 0
+        self.shed_count = 0
+
+        self.recent_waits = deque(maxlen=200)
+
+        self.reload()
+
+    def reload(self):
+        self.max_in_flight = config.get("scheduler.max_in_flight", 16)
+        self.max_per_server = config.get("scheduler.max_per_server", 4)
+        self.max_per_user = config.get("scheduler.max_per_user", 2)
+        self.max_queued = config.get("scheduler.max_queued", 16)
+        self.max_queued_per_user = config.get("scheduler.max_queued_per_user", 4)
+
+        self.shed_max_queued = config.get("shed.max_queued", 24)
+        self.shed_max_loop_lag = config.get("shed.max_loop_lag", 0.25)
+
+    async def measure_loop_lag(self, interval=1.0):
+        """ Runs forever, recording how late the event loop wakes us up. """
+
+        while 1:
+            t = self.loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag = max(0, self.loop.time() - t - interval)
+
+    def is_overloaded(self):
+        return self.queued >= self.shed_max_queued or self.loop_lag >= self.shed_max_loop_lag
+
+    async def run(self, server_key, user_key, coro_func, *args, bypass=0):
+        """ Wait for a slot, then await coro_func(*args).
+            If bypass is set, start immediately regardless of the caps.
+            Raises QueueFullError if the server already has
+            scheduler.max_queued commands waiting, or the user
+            scheduler.max_queued_per_user. """
+
+        if not bypass:
+            queue = self.queues.get(server_key)
+            if (queue is not None and len(queue) >= self.max_queued) or \
+                    self.queued_users[user_key] >= self.max_queued_per_user:
+                self.refused += 1
+                raise QueueFullError()
+
+        pending = PendingCommand(server_key, user_key, self.loop.create_future())
+        self.queued += 1
+
+        if bypass:
+            self.start(pending)
+        else:
+            self.queues.setdefault(server_key, deque()).append(pending)
+            self.queued_users[user_key] += 1
+            self.pump()
+
+        try:
+            await pending.future
+        except asyncio.CancelledError:
+            if pending.started:
+                self.release(pending)
+            else:
+                self.withdraw(pending)
+            raise
+
+        try:
+            return await coro_func(*args)
+        finally:
+            self.release(pending)
+
+    def start(self, pending):
+        pending.started = 1
+        self.queued -= 1
+        self.in_flight += 1
+        self.running_servers[pending.server_key] += 1
+        self.running_users[pending.user_key] += 1
+        self.recent_waits.append(time.monotonic() - pending.queued_at)
+
+        if not pending.future.done():
+            pending.future.set_result(None)
+
+    def release(self, pending):
+        self.in_flight -= 1
+
+        for counter, key in ((self.running_servers, pending.server_key),
+                             (self.running_users, pending.user_key)):
+            counter[key] -= 1
+            if counter[key] <= 0:
+                del counter[key]
+
+        self.pump()
+
+    def withdraw(self, pending):
+        queue = self.queues.get(pending.server_key)
+
+        if queue is not None and pending in queue:
+            queue.remove(pending)
+            self.queued -= 1
+            self.unqueue_user(pending.user_key)
+
+            if not queue:
+                del self.queues[pending.server_key]
+
+    def unqueue_user(self, user_key):
+        self.queued_users[user_key] -= 1
+        if self.queued_users[user_key] <= 0:
+            del self.queued_users[user_key]
+
+    def next_runnable(self):
+        for server_key, queue in self.queues.items():
+            if self.running_servers[server_key] >= self.max_per_server:
+                continue
+
+            for pending in queue:
+                if self.running_users[pending.user_key] < self.max_per_user:
+                    return pending
+
+        return None
+
+    def pump(self):
+        while self.in_flight < self.max_in_flight:
+            pending = self.next_runnable()
+
+            if pending is None:
+                break
+
+            queue = self.queues[pending.server_key]
+            queue.remove(pending)
+            self.unqueue_user(pending.user_key)
+
+            if queue:
+                self.queues.move_to_end(pending.server_key)
+            else:
+                del self.queues[pending.server_key]
+
+            self.start(pending)
+
+    def describe(self):
+        lines = ["in flight: {0}/{1}, queued: {2}, refused (queue full): {3}".format(
+            self.in_flight, self.max_in_flight, self.queued, self.refused),
+            "loop lag: {0:.3f} s, shed: {1}{2}".format(
+            self.loop_lag, self.shed_count, " (overloaded)" if self.is_overloaded() else "")]
+
+        if self.recent_waits:
+            lines.append("wait over last {0} commands: avg {1:.3f} s, max {2:.3f} s".format(
+                len(self.recent_waits),
+                sum(self.recent_waits) / len(self.recent_waits),
+                max(self.recent_waits)))
+
+        deepest = sorted(self.queues.items(), key=lambda x: len(x[1]), reverse=1)[:5]
+        for server_key, queue in deepest:
+            lines.append("- {0}: {1} queued, {2} running, oldest waiting {3:.1f} s".format(
+                server_key, len(queue), self.running_servers[server_key],
+                time.monotonic() - queue[0].queued_at))
+
+        return "\n".join(lines)
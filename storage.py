@@ -0,0 +1,70 @@
+import sqlite3
+
+# How every SQLite file the bot owns is opened and upgraded.
+#
+# Schemas are lists of migration scripts. Migration n (counting from 1)
+# is applied to files whose PRAGMA user_version is below n, inside one
+# transaction together with the version bump. Files made before
+# migrations existed are at version 0 and already have the tables, so
+# the first migration of each schema only uses CREATE ... IF NOT EXISTS.
+# Never edit a migration that has shipped; append a new one.
+
+PRAGMAS = """
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -8000;
+"""
+
+BUSY_TIMEOUT = 5.0
+STATEMENT_CACHE_SIZE = 256
+
+def connect(path):
+    """ A connection with WAL and the rest of PRAGMAS applied. sqlite3
+        keeps the prepared form of the last STATEMENT_CACHE_SIZE
+        statements per connection, so hold on to connections instead of
+        opening one per query. """
+
+    connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, cached_statements=STATEMENT_CACHE_SIZE)
+    connection.executescript(PRAGMAS)
+    return connection
+
+def schema_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(connection, migrations, path=""):
+    """ Apply the migrations connection's file hasn't seen yet. """
+
+    version = schema_version(connection)
+
+    for number, script in enumerate(migrations[version:], version + 1):
+        print("migrate: applying migration", number, "to", path)
+        try:
+            connection.executescript("BEGIN;\n{0};\nPRAGMA user_version = {1};\nCOMMIT;".format(script, number))
+        except Exception:
+            connection.rollback()
+            raise
+
+def dedupe(table, key):
+    """ SQL that keeps only the newest row for each value of key, so a
+        unique index can be put on it. """
+
+    return "DELETE FROM {0} WHERE rowid NOT IN (SELECT MAX(rowid) FROM {0} GROUP BY {1})".format(table, key)
+
+_fts5 = None
+
+def has_fts5():
+    """ Whether this sqlite3 was built with the FTS5 full-text index. """
+
+    global _fts5
+    if _fts5 is None:
+        connection = sqlite3.connect(":memory:")
+        try:
+            connection.execute("CREATE VIRTUAL TABLE probe USING fts5(text)")
+            _fts5 = True
+        except sqlite3.OperationalError:
+            _fts5 = False
+        finally:
+            connection.close()
+
+    return _fts5